@@ -5,10 +5,10 @@ from datetime import datetime, timedelta
 import argparse
 from tqdm import tqdm
 
-# Modify the library path on different machine
-mapol_path = os.path.expanduser('~/github/mapoltool')
+# Library path: this repository (scripts/split/../..)
+mapol_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 sys.path.append(mapol_path)
-from tools.aeronet_batch_split import *
+from tools.narwhal_split_aeronet import *
 
 def valid_date(s):
     try:
@@ -28,6 +28,11 @@ def main():
     parser.add_argument('--input_dir', type=str, required=True, help='Base directory for downloaded aeronet_data')
     parser.add_argument('--output_dir', type=str, required=True, help='Path for split output data')
     parser.add_argument('--overwrite', action='store_true', help='Overwrite existing files (default: False)')
+    parser.add_argument('--incremental', action='store_true', \
+                        help='Only split data added since the last split of the same file (checkpoint in output_dir)')
+    parser.add_argument('--verify_duplicates', action='store_true', \
+                        help='Re-read the processed day folders and remove duplicates (default: False, '
+                             'duplicates are already dropped when writing)')
     args = parser.parse_args()
 
     # Product subdirectory
@@ -71,22 +76,23 @@ def main():
         site_name=site_name,
         date_name=date_name,
         chunk_size=chunk_size,
-        overwrite=args.overwrite
+        overwrite=args.overwrite,
+        key_columns=[site_name, date_name, time_name],
+        incremental=args.incremental
     )
 
-    
-    
-    # Remove duplicates ONLY in folders corresponding to processed dates
+    # Duplicates are dropped when writing (keys in <site>.csv.keys),
+    # only check the folders of the processed dates again if asked
     current_date = args.start_date
-    while current_date <= args.end_date:
+    while args.verify_duplicates and current_date <= args.end_date:
         subfolder = os.path.join(base_out_dir, current_date.strftime("%Y%m%d"))
         if os.path.isdir(subfolder):
             print(f"Removing duplicates in: {subfolder}")
-            remove_duplicates_in_csv_files=remove_duplicates_in_csv_files(
+            sites_with_duplicates = remove_duplicates_in_csv_files(
                 output_dir=subfolder,
                 key_columns=[site_name, date_name, time_name]
             )
-            print("verify duplicated sites", remove_duplicates_in_csv_files)
+            print("verify duplicated sites", sites_with_duplicates)
         else:
             print(f"Subfolder does not exist: {subfolder}, skipping duplicate removal.")
         current_date += timedelta(days=1)
@@ -13,17 +13,24 @@ import os
 import re
 
 import traceback
+import warnings
 
 import numpy as np
 import pandas as pd
 import xarray as xr
 import pickle
-from tqdm import tqdm
 import matplotlib.pyplot as plt
 from datetime import datetime
+from functools import partial
 
-from tools.aeronet_matchup_match import subset_pace_df, match_time_aeronet
-from tools.aeronet_matchup_format import format_aeronet_df, format_pace_df, get_val_df
+from tools.aeronet_matchup_match import subset_pace_df, match_time_aeronet, match_time_aeronet_sites
+from tools.aeronet_matchup_format import format_aeronet_df, format_pace_df, get_val_df, get_val_df_sites
+from tools.aeronet_matchup_search import map_granules, match_granule, get_boundingbox
+from tools.narwhal_footprint import select_granules
+from tools.narwhal_granule import get_granule_timestamp
+
+#number of day folders where subset_time_pace_aeronet_grouped fell back to site by site
+GROUPED_FALLBACK = {'count': 0}
 
 def subset_time_pace_aeronet(folder1, site1v, pace_df_mean_all, pace_df_std_all, wvv, all_vars,\
                        extra_vars=['chi2', 'count','nv_ref','nv_dolp', 'aeronet_lon', 'aeronet_lat', \
@@ -32,7 +39,8 @@ def subset_time_pace_aeronet(folder1, site1v, pace_df_mean_all, pace_df_std_all,
                                    'distance1_haversine','distance2_euclidean'],\
                         delta_hour=1, flag_subset_pace=True, \
                         old_start1='AOD_', old_end1='nm', new_start1='aot_wv',\
-                       input_is_sda=False, val_source='AERONET', df0=None, max_order=1,tmp_plot_path0=None):
+                       input_is_sda=False, val_source='AERONET', df0=None, max_order=1,tmp_plot_path0=None,\
+                       interp_mode=None, fit_diag=None):
     """
     now search the aeronet data to match with pace, within delta_hour, for each variable
     when input_is_sda=True, use internal interpolation based on angstrom to get aod, aod_fine, aod_coarse
@@ -63,7 +71,8 @@ def subset_time_pace_aeronet(folder1, site1v, pace_df_mean_all, pace_df_std_all,
                                    old_start1=old_start1, old_end1=old_end1, new_start1=new_start1,\
                                                              input_is_sda=input_is_sda, \
                                                               site_name=site_name, \
-                                                              df0=df0, max_order=max_order,tmp_plot_path0=tmp_plot_path0)
+                                                              df0=df0, max_order=max_order,tmp_plot_path0=tmp_plot_path0,\
+                                                              interp_mode=interp_mode, fit_diag=fit_diag)
             #print(aeronet_df2)
             
             print("**wavelength in aeronet or man:", orig_wavelengths)
@@ -117,6 +126,66 @@ def subset_time_pace_aeronet(folder1, site1v, pace_df_mean_all, pace_df_std_all,
 
     return all_target_mean_df, all_target_std_df, all_pace_mean_df, all_pace_std_df
 
+def subset_time_pace_aeronet_grouped(folder1, site1v, pace_df_mean_all, pace_df_std_all, wvv, all_vars,\
+                       extra_vars=['chi2', 'count','nv_ref','nv_dolp', 'aeronet_lon', 'aeronet_lat', \
+                                   'pace_lon','pace_lat',\
+                                   'pace_loc_index_lon','pace_loc_index_lat', \
+                                   'distance1_haversine','distance2_euclidean'],\
+                        delta_hour=1, flag_subset_pace=True, \
+                        old_start1='AOD_', old_end1='nm', new_start1='aot_wv',\
+                       input_is_sda=False, val_source='AERONET', df0=None, max_order=1,tmp_plot_path0=None,\
+                       interp_mode=None, fit_diag=None):
+    """
+    same as subset_time_pace_aeronet, but for all the sites at once:
+    the validation data of all the sites in folder1 is loaded into one df, formatted and
+    interpolated once, and matched with pace by (site, time window) in one grouped join
+
+    if the data can not be processed together (KeyError/ValueError, e.g. missing columns or empty frames),
+    fall back to subset_time_pace_aeronet (site by site) with a warning, counted in GROUPED_FALLBACK,
+    other errors are raised
+    """
+    try:
+        aeronet_df1, site_name = get_val_df_sites(val_source, folder1, site1v)
+
+        aeronet_df2, orig_wavelengths = format_aeronet_df(aeronet_df1, input_wavelengths=wvv,\
+                               old_start1=old_start1, old_end1=old_end1, new_start1=new_start1,\
+                                                         input_is_sda=input_is_sda, \
+                                                          site_name=site_name, \
+                                                          df0=df0, max_order=max_order,tmp_plot_path0=tmp_plot_path0,\
+                                                              interp_mode=interp_mode, fit_diag=fit_diag)
+        print("**wavelength in aeronet or man:", orig_wavelengths)
+
+        if(flag_subset_pace):
+            pace_df_mean_all, pace_df_std_all = subset_pace_df(pace_df_mean_all, pace_df_std_all, \
+                                                               all_vars, extra_vars)
+
+        all_target_mean_df, all_target_std_df, all_pace_mean_df, all_pace_std_df \
+            = match_time_aeronet_sites(pace_df_mean_all, pace_df_std_all, aeronet_df2, site1v, delta_hour=delta_hour)
+
+    except (KeyError, ValueError) as e:
+        GROUPED_FALLBACK['count'] += 1
+        warnings.warn(f"Error processing all sites together in {folder1}: {e!r}, process site by site "
+                      f"(fallback {GROUPED_FALLBACK['count']} times)")
+        traceback.print_exc()
+        return subset_time_pace_aeronet(folder1, site1v, pace_df_mean_all, pace_df_std_all, wvv, all_vars,\
+                                        extra_vars=extra_vars, delta_hour=delta_hour, flag_subset_pace=flag_subset_pace, \
+                                        old_start1=old_start1, old_end1=old_end1, new_start1=new_start1,\
+                                        input_is_sda=input_is_sda, val_source=val_source, df0=df0, \
+                                        max_order=max_order, tmp_plot_path0=tmp_plot_path0, interp_mode=interp_mode, \
+                                        fit_diag=fit_diag)
+
+    if all_target_mean_df.empty:
+        print("No AERONET and PACE matchup found")
+        return None, None, None, None
+
+    print("===found====:", all_target_mean_df['site'].nunique(), "sites")
+    all_target_mean_df = all_target_mean_df.reset_index(drop=True)
+    all_target_std_df = all_target_std_df.reset_index(drop=True)
+    all_pace_mean_df = all_pace_mean_df.reset_index(drop=True)
+    all_pace_std_df = all_pace_std_df.reset_index(drop=True)
+
+    return all_target_mean_df, all_target_std_df, all_pace_mean_df, all_pace_std_df
+
 
 def prepare_date(aeronet_path1, suite1, date_list):
     folder1v = []  # Initialize the list to store folder paths
@@ -145,6 +214,25 @@ def prepare_date(aeronet_path1, suite1, date_list):
     return folder1v
 
 
+def get_date_site_index(pace_df_mean_all, delta_hour=1):
+    """
+    index of the sites with pace data on each day: {'YYYYMMDD': set of sites}
+    a pace time within delta_hour of midnight is also added to the neighbor day,
+    since the validation data in that day folder may be matched
+    """
+    date_site_index = {}
+    if pace_df_mean_all is None or len(pace_df_mean_all) == 0:
+        return date_site_index
+
+    delta = pd.Timedelta(hours=delta_hour if delta_hour else 0)
+    datetime1 = pace_df_mean_all['datetime']
+    for datetime2 in [datetime1 - delta, datetime1, datetime1 + delta]:
+        df1 = pd.DataFrame({'date': datetime2.dt.strftime('%Y%m%d'), 'site': pace_df_mean_all['site']}).dropna()
+        for date1, sites in df1.groupby('date')['site']:
+            date_site_index.setdefault(date1, set()).update(sites)
+
+    return date_site_index
+
 def prepare_vars(wvv, current_vars=['datetime', 'site'], var_pattern="aot_wv"):
     """
     get aeronet folder for that day, 
@@ -167,67 +255,170 @@ def prepare_vars(wvv, current_vars=['datetime', 'site'], var_pattern="aot_wv"):
     
 
 
-def subset_loc_pace_data(indexvv, filev, rules, search_grid_delta=2, save_subset_loc_path=None, decode_timedelta=False):
+def get_pace_vars(val_source, rules=None, csv_path=None, \
+                  base_vars=['chi2', 'nv_ref', 'nv_dolp', 'quality_flag', 'aot', \
+                             'wavelength', 'wavelength3d', 'wavelength_3d', 'longitude', 'latitude']):
+    """
+    pace variables needed to validate with val_source, from val_var_list.csv:
+    new_start1 without '_wv' (aot_wv -> aot, ssa_wv -> ssa, angstrom_440_870),
+    plus the rule variables and base_vars (aot is needed for aot550 and aot_wv550)
+    """
+    if csv_path is None:
+        csv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../data/val_var_list.csv')
+    df_var = pd.read_csv(csv_path, skipinitialspace=True)
+    df_var1 = df_var.loc[df_var.val_source == val_source]
+
+    pace_vars = list(base_vars)
+    if rules:
+        pace_vars += list(rules.keys())
+    for new_start1 in df_var1['new_start1']:
+        pace_vars.append(re.sub(r'_wv$', '', new_start1.strip()))
+
+    pace_vars = list(dict.fromkeys(pace_vars))
+    print("pace variables to read:", pace_vars)
+    return pace_vars
+
+def merge_granule(datatree, pace_vars=None):
+    """
+    merge all the groups of the granule into one dataset,
+    if pace_vars is given, only keep these variables before any data is loaded
+    """
+    if pace_vars is None:
+        return xr.merge(datatree.to_dict().values())
+
+    datasetv = []
+    for dataset in datatree.to_dict().values():
+        keep_vars = [var for var in dataset.data_vars if var in pace_vars]
+        if keep_vars:
+            datasetv.append(dataset[keep_vars])
+    return xr.merge(datasetv)
+
+def search_extract_pace_data(aeronet_df1, filev, rules, search_center_radius=10, search_grid_delta=2, \
+                             aeronet_lon_var='Longitude(decimal_degrees)', aeronet_lat_var='Latitude(decimal_degrees)', \
+                             aeronet_site_var='Site_Name', match_mode='batch', footprint_db=None, \
+                             save_subset_loc_path=None, decode_timedelta=False, n_workers=1, pace_vars=None):
+    """
+    search the validation sites and extract the pace data in one pass per granule
+    (same as aeronet_search + subset_loc_pace_data, but each granule is opened only once)
+
+    pace_vars: only read these pace variables (get_pace_vars), None: all the variables
+
+    return indexvv, boundingboxv (for plot_search), df_mean_all, df_std_all, wvv
+    wvv is None if no location is found in any granule
+    """
+    locv = aeronet_df1[[aeronet_lon_var,aeronet_lat_var]].to_numpy()
+    lon_loc, lat_loc = locv[:,0], locv[:,1]
+    namev = aeronet_df1[aeronet_site_var].to_numpy()
+
+    if(footprint_db):
+        filev = select_granules(filev, lon_loc, lat_loc, search_center_radius, footprint_db)
+
+    indexvv = {}
+    boundingboxv = {}
+    df_mean_all = []
+    df_std_all = []
+    wvv = None
+
+    #one kdtree thread in each worker process, the processes already use the cpus
+    kdtree_workers = 1 if (n_workers is not None and n_workers > 1) else -1
+    func = partial(process_granule, lon_loc=lon_loc, lat_loc=lat_loc, namev=namev, rules=rules, \
+                   search_center_radius=search_center_radius, search_grid_delta=search_grid_delta, \
+                   match_mode=match_mode, save_subset_loc_path=save_subset_loc_path, \
+                   decode_timedelta=decode_timedelta, pace_vars=pace_vars, kdtree_workers=kdtree_workers)
+
+    for result in map_granules(func, filev[:], n_workers=n_workers):
+        if result is None:
+            continue
+        timestamp, indexv, boundingbox, df_mean, df_std, wvv1 = result
+        indexvv[timestamp] = indexv
+        boundingboxv[timestamp] = boundingbox
+        df_mean_all.append(df_mean)
+        df_std_all.append(df_std)
+        if wvv1 is not None:
+            wvv = wvv1
+
+    df_mean_all = concat_entries(df_mean_all)
+    df_std_all = concat_entries(df_std_all)
+
+    return indexvv, boundingboxv, df_mean_all, df_std_all, wvv
+
+def process_granule(nc_path, lon_loc, lat_loc, namev, rules, search_center_radius=10, search_grid_delta=2, \
+                    match_mode='batch', save_subset_loc_path=None, decode_timedelta=False, pace_vars=None, \
+                    kdtree_workers=-1):
+    """
+    open the granule once (lazily): read lon/lat, search the sites,
+    only when sites are found, merge the groups and compute the mean and std around them
+
+    return timestamp, indexv, boundingbox, df_mean, df_std, wvv
+    or None if the granule failed
+    """
+    try:
+        timestamp = get_granule_timestamp(nc_path)
+        with xr.open_datatree(nc_path, decode_timedelta=decode_timedelta) as datatree:
+            lon_pace = datatree['geolocation_data/longitude'].values
+            lat_pace = datatree['geolocation_data/latitude'].values
+            boundingbox = get_boundingbox(lon_pace, lat_pace)
+
+            indexv = match_granule(timestamp, lon_pace, lat_pace, lon_loc, lat_loc, namev, \
+                                   search_center_radius=search_center_radius, match_mode=match_mode, \
+                                   kdtree_workers=kdtree_workers)
+            if len(indexv) == 0:
+                return timestamp, indexv, boundingbox, pd.DataFrame(), pd.DataFrame(), None
+
+            dataset = merge_granule(datatree, pace_vars=pace_vars)
+            dataset = format_pace_df(dataset, flag_aot550=True)
+            df_mean, df_std, wvv = extract_entries(dataset, timestamp, indexv, rules, \
+                                                   search_grid_delta=search_grid_delta, \
+                                                   save_subset_loc_path=save_subset_loc_path)
+        return timestamp, indexv, boundingbox, df_mean, df_std, wvv
+
+    except Exception as e:
+        print(f"  Error processing path {nc_path}: {str(e)}")
+        print("  Full traceback:")
+        traceback.print_exc()
+        return None
+
+def subset_loc_pace_data(indexvv, filev, rules, search_grid_delta=2, save_subset_loc_path=None, decode_timedelta=False, \
+                         n_workers=1, pace_vars=None):
     """
     extract pace data using a size of pixel radius range of search_grid_delta
     return df_mean_all, df_std_all, which containthe mean and std of all the variables in the nc files
 
     decode_timedelta=False: handle a possible future behavior
+    n_workers: number of processes to extract the granules (1: in the current process),
+        rows are concatenated in the order of indexvv
+    pace_vars: only read these pace variables (get_pace_vars), None: all the variables
+
+    the granule of each key in indexvv is found by its timestamp in filev
     """
 
     df_mean_all = []
     df_std_all = []
-    
-    df_mean_all = []
-    df_std_all = []
-    
-    for i1, timestamp in tqdm(enumerate(indexvv.keys())):
-        indexv = indexvv[timestamp]
-        nc_path = filev[i1]
-        #print(nc_path)
-        datatree = xr.open_datatree(nc_path, decode_timedelta=decode_timedelta)
-        dataset = xr.merge(datatree.to_dict().values())
-        
-        dataset = format_pace_df(dataset, flag_aot550=True)
-        
-        for i1, entry in enumerate(indexv):
+    wvv = None
 
-            pace_loc_index = entry['pace_loc_index']
-            print("check entry:", i1)
-            df_mean, df_std, wvv = get_mean_std_xr(dataset, pace_loc_index, search_grid_delta, \
-                                                   rules, timestamp, i1, save_subset_loc_path=save_subset_loc_path)
-            
-            mean_row = df_mean.iloc[0].to_dict()
-            std_row = df_std.iloc[0].to_dict()
-            # Metadata: simple fields
-            #'distance0_kdtree':dis0, 'distance1_haversine':dis1, 'distance2_euclidean':dis2
-            for key in ['site_index', 'site', 'pace_date', 'distance0_kdtree', 'distance1_haversine', 'distance2_euclidean']:
-                mean_row[key] = entry[key]
-                std_row[key] = entry[key]
-            mean_row['timestamp'] = timestamp
-            std_row['timestamp'] = timestamp
-            # Split location info into two columns each 
-            # pace_loc_index (tuple of ints)
-            mean_row['pace_loc_index_lon'] = int(entry['pace_loc_index'][0])
-            mean_row['pace_loc_index_lat'] = int(entry['pace_loc_index'][1])
-            std_row['pace_loc_index_lon'] = int(entry['pace_loc_index'][0])
-            std_row['pace_loc_index_lat'] = int(entry['pace_loc_index'][1])
-            # aeronet_loc (array-like, lon/lat convention)
-            mean_row['aeronet_lon'] = float(entry['aeronet_loc'][0])
-            mean_row['aeronet_lat'] = float(entry['aeronet_loc'][1])
-            std_row['aeronet_lon'] = float(entry['aeronet_loc'][0])
-            std_row['aeronet_lat'] = float(entry['aeronet_loc'][1])
-            # pace_loc (list-like, lon/lat)
-            mean_row['pace_lon'] = float(entry['pace_loc'][0])
-            mean_row['pace_lat'] = float(entry['pace_loc'][1])
-            std_row['pace_lon'] = float(entry['pace_loc'][0])
-            std_row['pace_lat'] = float(entry['pace_loc'][1])
-            # Append
-            df_mean_all.append(mean_row)
-            df_std_all.append(std_row)
+    pathv = {get_granule_timestamp(nc_path): nc_path for nc_path in filev}
+    itemv = []
+    for timestamp in indexvv.keys():
+        if timestamp not in pathv:
+            print(f"  ***Warning: no granule found for {timestamp}, skip")
+            continue
+        itemv.append((timestamp, indexvv[timestamp], pathv[timestamp]))
+
+    func = partial(extract_granule, rules=rules, search_grid_delta=search_grid_delta, \
+                   save_subset_loc_path=save_subset_loc_path, decode_timedelta=decode_timedelta, \
+                   pace_vars=pace_vars)
+
+    for df_mean, df_std, wvv1 in map_granules(func, itemv, n_workers=n_workers):
+        df_mean_all.append(df_mean)
+        df_std_all.append(df_std)
+        if wvv1 is not None:
+            wvv = wvv1
+
+    if wvv is None:
+        raise ValueError("no pace pixel found for the matched locations")
     
-    df_mean_all = pd.DataFrame(df_mean_all)
-    df_std_all = pd.DataFrame(df_std_all)
+    df_mean_all = concat_entries(df_mean_all)
+    df_std_all = concat_entries(df_std_all)
     
     # Convert lists of dicts into DataFrames
     #df_mean_all = pd.DataFrame(df_mean_all)
@@ -235,6 +426,90 @@ def subset_loc_pace_data(indexvv, filev, rules, search_grid_delta=2, save_subset
 
     return df_mean_all, df_std_all, wvv
 
+def extract_granule(item, rules, search_grid_delta=2, save_subset_loc_path=None, decode_timedelta=False, \
+                    pace_vars=None):
+    """
+    mean and std around all the matched locations in one granule, also used by the worker processes
+    item: (timestamp, indexv, nc_path)
+
+    return df_mean, df_std, and the wavelength (None if no location)
+    """
+    timestamp, indexv, nc_path = item
+
+    #print(nc_path)
+    with xr.open_datatree(nc_path, decode_timedelta=decode_timedelta) as datatree:
+        dataset = merge_granule(datatree, pace_vars=pace_vars)
+        dataset = format_pace_df(dataset, flag_aot550=True)
+        df_mean, df_std, wvv = extract_entries(dataset, timestamp, indexv, rules, \
+                                               search_grid_delta=search_grid_delta, \
+                                               save_subset_loc_path=save_subset_loc_path)
+    return df_mean, df_std, wvv
+
+def extract_entries(dataset, timestamp, indexv, rules, search_grid_delta=2, save_subset_loc_path=None):
+    """
+    mean and std around each matched location (entry of indexv) in the formatted dataset
+    metadata of the entry is added to each row
+
+    return df_mean, df_std (one row per entry), and the wavelength (None if no location)
+    """
+    wvv = None
+    if len(indexv) == 0:
+        return pd.DataFrame(), pd.DataFrame(), wvv
+
+    #filter mask is applied once on the full granule, the windows of all the entries are computed together
+    masked = get_masked_arrays(dataset, rules)
+
+    if masked is None:
+        mean_rows = []
+        std_rows = []
+        for i1, entry in enumerate(indexv):
+            print("check entry:", i1)
+            df_mean1, df_std1, wvv = get_mean_std_xr(dataset, entry['pace_loc_index'], search_grid_delta, \
+                                                     rules, timestamp, i1, save_subset_loc_path=save_subset_loc_path)
+            mean_rows.append(df_mean1.iloc[0].to_dict())
+            std_rows.append(df_std1.iloc[0].to_dict())
+        df_mean = pd.DataFrame(mean_rows)
+        df_std = pd.DataFrame(std_rows)
+    else:
+        wvv = dataset['wavelength'].values
+        wl_values = [int(round(wl)) for wl in wvv]
+        if(save_subset_loc_path):
+            for i1, entry in enumerate(indexv):
+                save_subset_loc(dataset, entry['pace_loc_index'], search_grid_delta, timestamp, i1, save_subset_loc_path)
+        df_mean, df_std = get_mean_std_batch(masked, [entry['pace_loc_index'] for entry in indexv], \
+                                             search_grid_delta, wl_values)
+    print("number of entries:", len(indexv))
+
+    # Metadata: simple fields
+    #'distance0_kdtree':dis0, 'distance1_haversine':dis1, 'distance2_euclidean':dis2
+    metadata = {}
+    for key in ['site_index', 'site', 'pace_date', 'distance0_kdtree', 'distance1_haversine', 'distance2_euclidean']:
+        metadata[key] = [entry[key] for entry in indexv]
+    metadata['timestamp'] = [timestamp]*len(indexv)
+    # Split location info into two columns each 
+    # pace_loc_index (tuple of ints)
+    metadata['pace_loc_index_lon'] = [int(entry['pace_loc_index'][0]) for entry in indexv]
+    metadata['pace_loc_index_lat'] = [int(entry['pace_loc_index'][1]) for entry in indexv]
+    # aeronet_loc (array-like, lon/lat convention)
+    metadata['aeronet_lon'] = [float(entry['aeronet_loc'][0]) for entry in indexv]
+    metadata['aeronet_lat'] = [float(entry['aeronet_loc'][1]) for entry in indexv]
+    # pace_loc (list-like, lon/lat)
+    metadata['pace_lon'] = [float(entry['pace_loc'][0]) for entry in indexv]
+    metadata['pace_lat'] = [float(entry['pace_loc'][1]) for entry in indexv]
+
+    for key, values in metadata.items():
+        df_mean[key] = values
+        df_std[key] = values
+
+    return df_mean, df_std, wvv
+
+def concat_entries(dfv):
+    """concat the per granule results, empty DataFrame if nothing found"""
+    dfv = [df for df in dfv if len(df) > 0]
+    if len(dfv) == 0:
+        return pd.DataFrame()
+    return pd.concat(dfv, ignore_index=True)
+
 def filter_subset(subset, rules):
     """
     Filter ALL variables in the dataset based on the combined rules.
@@ -402,4 +677,203 @@ def get_mean_std_xr(dataset, pace_loc_index, delta, rules, timestamp, i1, save_s
     df_mean = pd.DataFrame([mean_dict])
     df_std = pd.DataFrame([std_dict])
     return df_mean, df_std, wvv
-    
\ No newline at end of file
+
+def get_filter_mask(dataset, rules):
+    """
+    combined mask of the rules (same as filter_subset) on the full granule,
+    as a numpy array of (number_of_lines, pixels_per_line)
+
+    return None if no rule variable is found
+    """
+    valid_rules = {}
+    for key, values in rules.items():
+        if key in dataset.data_vars:
+            valid_rules[key] = values
+        else:
+            print(f"          ***Warning: Variable '{key}' not found in dataset, skipping rule")
+
+    if not valid_rules:
+        print("Warning: No valid rule variables found in dataset")
+        return None
+
+    combined_mask = None
+    for key1, values in valid_rules.items():
+        if len(values) == 1:
+            condition = (dataset[key1] == values[0])
+        elif len(values) == 2:
+            min_val, max_val = values
+            condition = (dataset[key1] >= min_val) & (dataset[key1] <= max_val)
+        else:
+            print(f"          ***Warning: Invalid rule format for '{key1}'. Expected 1 or 2 values, got {len(values)}")
+            continue
+        combined_mask = condition if combined_mask is None else (combined_mask & condition)
+
+    if combined_mask is None:
+        combined_mask = xr.ones_like(dataset[list(valid_rules.keys())[0]], dtype=bool)
+
+    mask = combined_mask.transpose('number_of_lines', 'pixels_per_line').values
+    print(f"          Valid pixels in granule after filtering: {np.count_nonzero(mask)}")
+    return mask
+
+def get_masked_arrays(dataset, rules):
+    """
+    apply the filter mask once on the full granule
+
+    spatial variables are masked and transposed to (number_of_lines, pixels_per_line, ...),
+    the other variables are kept and masked per window (broadcast, as in filter_subset)
+
+    return dict with mask, shape and vars: {var: (values, dims, is_spatial)} in the order of data_vars
+    or None if the mask cannot be made on the granule grid (use get_mean_std_xr)
+    """
+    try:
+        mask = get_filter_mask(dataset, rules)
+    except Exception as e:
+        print(f"          ***Warning: cannot compute the filter mask on the granule: {e}")
+        return None
+
+    spatial_dims = ('number_of_lines', 'pixels_per_line')
+    shape = (dataset.sizes['number_of_lines'], dataset.sizes['pixels_per_line'])
+    mask_da = None if mask is None else xr.DataArray(mask, dims=spatial_dims)
+
+    varv = {}
+    for var in dataset.data_vars:
+        da = dataset[var]
+        if all(dim in da.dims for dim in spatial_dims):
+            if mask_da is not None:
+                da = da.where(mask_da)
+            da = da.transpose(*spatial_dims, ...)
+            varv[var] = (da.values, da.dims, True)
+        else:
+            varv[var] = (da.values, da.dims, False)
+
+    return {'mask': mask, 'shape': shape, 'vars': varv}
+
+def get_window_slices(shape, pace_loc_index, delta):
+    """line and pixel slices of +-delta around pace_loc_index, within the granule"""
+    line_start = max(pace_loc_index[0] - delta, 0)
+    line_end = min(pace_loc_index[0] + delta + 1, shape[0])
+    pix_start = max(pace_loc_index[1] - delta, 0)
+    pix_end = min(pace_loc_index[1] + delta + 1, shape[1])
+    return slice(line_start, line_end), slice(pix_start, pix_end)
+
+def save_subset_loc(dataset, pace_loc_index, delta, timestamp, i1, save_subset_loc_path):
+    """save the window (before filtering) to {timestamp}_{i1}.nc, same as get_mean_std_xr"""
+    line_slice, pix_slice = get_window_slices((dataset.sizes['number_of_lines'], dataset.sizes['pixels_per_line']), \
+                                              pace_loc_index, delta)
+    subset = dataset.isel(number_of_lines=line_slice, pixels_per_line=pix_slice)
+    filename = os.path.join(save_subset_loc_path, f"{timestamp}_{i1}.nc")
+    subset.to_netcdf(filename)
+
+def get_mean_std_batch(masked, pace_loc_indexv, delta, wl_values):
+    """
+    same as get_mean_std_xr for all the locations of a granule, with the arrays from get_masked_arrays:
+    the windows of all the sites are stacked into (n_sites, window, n_columns), one column per
+    variable (per wavelength for 3d variables), and nanmean, nanstd and count are computed
+    for all the columns together
+
+    pixels of the window outside the granule are set to nan
+
+    return df_mean, df_std, one row per location, columns in the same order as get_mean_std_xr
+    """
+    shape = masked['shape']
+    mask = masked['mask']
+
+    locv = np.asarray(pace_loc_indexv, dtype=int).reshape(-1, 2)
+    n_sites = len(locv)
+    offset = np.arange(-delta, delta+1)
+    lines = locv[:, 0:1] + offset
+    pixels = locv[:, 1:2] + offset
+    in_window = ((lines >= 0) & (lines < shape[0]))[:, :, None] & ((pixels >= 0) & (pixels < shape[1]))[:, None, :]
+    lines = np.clip(lines, 0, shape[0]-1)[:, :, None]
+    pixels = np.clip(pixels, 0, shape[1]-1)[:, None, :]
+    in_window = in_window.reshape(n_sites, -1)
+
+    def get_window(values):
+        """(n_sites, window, ...) of a spatial array, nan outside the granule"""
+        win = values[lines, pixels].astype(float)
+        win = win.reshape((n_sites, -1) + values.shape[2:])
+        win[~in_window] = np.nan
+        return win
+
+    mask_window = None if mask is None else (get_window(mask) == 1)
+
+    #columns: (name, index in the stack), or (name, mean, std) computed separately,
+    #count columns refer to the index of chi2
+    columnv = []
+    stackv = []
+
+    def add_column(name, arr, is_chi2, count_name):
+        if arr.ndim == 2 and arr.shape[1] == in_window.shape[1]:
+            columnv.append((name, 'stack', len(stackv)))
+            if is_chi2:
+                columnv.append((count_name, 'count', len(stackv)))
+            stackv.append(arr)
+        else:
+            arr = arr.reshape(n_sites, -1)
+            count = np.count_nonzero(~np.isnan(arr), axis=1)
+            columnv.append((name, 'extra', (np.nanmean(arr, axis=1), np.nanstd(arr, axis=1))))
+            if is_chi2:
+                columnv.append((count_name, 'extra', (count, count)))
+
+    with warnings.catch_warnings():
+        #windows without valid pixels give nan, same as get_mean_std_xr
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+
+        for var, (values, dims, is_spatial) in masked['vars'].items():
+            try:
+                if values.dtype.kind not in 'biuf':
+                    raise TypeError(f"dtype {values.dtype}")
+                #ndim: dimension of the variable in get_mean_std_xr (after filter_subset)
+                #arr: (n_sites, ...) with the dimensions dims_arr after the site axis
+                if is_spatial:
+                    ndim = len(dims)
+                    if ndim > 3:
+                        continue  # Skip variables with more than 3 dimensions
+                    arr = get_window(values)
+                    dims_arr = ('window',) + tuple(dims[2:])
+                elif mask_window is not None:
+                    #broadcast the window mask to the variable, as filter_subset
+                    ndim = len(dims) + 2
+                    if ndim > 3:
+                        continue
+                    arr = np.where(mask_window.reshape(mask_window.shape + (1,)*values.ndim), \
+                                   values.astype(float), np.nan)
+                    dims_arr = ('window',) + tuple(dims)
+                else:
+                    #not filtered and not in the window: same value for all the sites
+                    ndim = len(dims)
+                    if ndim > 3:
+                        continue
+                    arr = np.broadcast_to(values.astype(float), (n_sites,) + values.shape)
+                    dims_arr = tuple(dims)
+
+                if 'wavelength' in dims_arr and ndim == 3:
+                    iaxis = dims_arr.index('wavelength') + 1
+                    for i, wl in enumerate(wl_values):
+                        add_column(f'{var}_wv{wl}', np.take(arr, i, axis=iaxis), var == 'chi2', f'count_wv{wl}')
+                else:
+                    add_column(var, arr, var == 'chi2', 'count')
+            except Exception:
+                print('======failed to load======', var)
+
+        if stackv:
+            stack = np.stack(stackv, axis=-1)
+            mean_stack = np.nanmean(stack, axis=1)
+            std_stack = np.nanstd(stack, axis=1)
+            count_stack = np.count_nonzero(~np.isnan(stack), axis=1)
+
+    mean_dict = {}
+    std_dict = {}
+    for name, kind, value in columnv:
+        if kind == 'stack':
+            mean_dict[name] = mean_stack[:, value]
+            std_dict[name] = std_stack[:, value]
+        elif kind == 'count':
+            mean_dict[name] = count_stack[:, value]
+            std_dict[name] = count_stack[:, value]
+        else:
+            mean_dict[name], std_dict[name] = value
+
+    df_mean = pd.DataFrame(mean_dict, index=range(n_sites))
+    df_std = pd.DataFrame(std_dict, index=range(n_sites))
+    return df_mean, df_std
@@ -1,14 +1,17 @@
 import re
 import os
+from functools import lru_cache
 import numpy as np
 import pandas as pd
 
 from scipy.interpolate import UnivariateSpline
 from tools.aeronet_matchup_sda import get_sda_aod
-from tools.aeronet_oc import get_aeronet_oc_rrs
+from tools.aeronet_oc import get_aeronet_oc_rrs_all, get_earthsun_distance
 from tools.aeronet_matchup_match import get_aeronet_fit_spline, get_aeronet_fit_polynomial, \
-                                check_aeronet_fit, get_aeronet_key            
-from tools.aeronet_matchup_man import get_man_site
+                                get_aeronet_fit_angstrom, check_aeronet_fit, get_aeronet_key, \
+                                add_fit_diagnostics            
+from tools.aeronet_matchup_man import get_man_site, get_man_csv
+from tools.narwhal_parquet_store import is_store_day, read_store_day
 
 def clean_pace_data(df_mean_all, df_std_all):
     """
@@ -182,8 +185,11 @@ def get_val_df(val_source, folder1, site1):
         #add p0 ... to aeronet_site and create site_name
         #note different variable name as site name
     elif(val_source.upper() in ['AERONET', 'AERONET_OC']):
-        #AERONET, AERONET OC
-        aeronet_df1 = pd.read_csv(os.path.join(folder1, site1 + '.csv'))
+        #AERONET, AERONET OC, from the csv file of the site or the parquet store
+        if is_store_day(folder1):
+            aeronet_df1 = read_store_day(folder1, sites=[site1])
+        else:
+            aeronet_df1 = pd.read_csv(os.path.join(folder1, site1 + '.csv'))
         site_name='AERONET_Site'
     else:
         print(f"canot load df, {val_source} do not exist")
@@ -196,10 +202,54 @@ def get_val_df(val_source, folder1, site1):
     
     return aeronet_df1, site_name
 
+def get_val_df_sites(val_source, folder1, site1v):
+    """
+    get validation data of all the sites in site1v for the day folder1, in one df
+    (same as get_val_df, site by site files of AERONET/AERONET_OC are concatenated,
+    MAN/PACE_PAX/EARTHCARE folder is read once)
+    """
+    if(val_source.upper() in ['MAN','PACE_PAX', 'EARTHCARE']):
+        dfv2 = get_man_csv(folder1)
+        if len(dfv2) == 0:
+            raise ValueError(f"no data found in {folder1}")
+        aeronet_df1 = dfv2.loc[dfv2.Site_Name.isin(site1v)]
+        site_name='Site_Name'
+    elif(val_source.upper() in ['AERONET', 'AERONET_OC']) and is_store_day(folder1):
+        #parquet store, all the sites in one read
+        aeronet_df1 = read_store_day(folder1, sites=site1v)
+        if len(aeronet_df1) == 0:
+            raise ValueError(f"no site found in {folder1}")
+        site_name='AERONET_Site'
+    elif(val_source.upper() in ['AERONET', 'AERONET_OC']):
+        dfv = []
+        for site1 in site1v:
+            file1 = os.path.join(folder1, site1 + '.csv')
+            if not os.path.isfile(file1):
+                print("---no data from this site:", site1)
+                continue
+            dfv.append(pd.read_csv(file1))
+        if len(dfv) == 0:
+            raise ValueError(f"no site found in {folder1}")
+        aeronet_df1 = pd.concat(dfv, ignore_index=True)
+        site_name='AERONET_Site'
+    else:
+        raise ValueError(f"canot load df, {val_source} do not exist")
+
+    aeronet_df1 = aeronet_df1.replace(-999, np.nan)
+    aeronet_df1 = aeronet_df1.dropna(axis=1, how='all')
+    aeronet_df1 = aeronet_df1.reset_index(drop=True)
+
+    return aeronet_df1, site_name
+
+@lru_cache(maxsize=256)
+def clean_columns(columns):
+    """remove the extra (int) in the MAN variable names, cached by the header"""
+    return tuple(re.sub(r'\(int\)', '', c) if isinstance(c, str) else c for c in columns)
+
 def format_aeronet_df(aeronet_df1, input_wavelengths = [440, 550, 670, 870], \
                      old_start1='AOD_', old_end1='nm', new_start1='aot_wv',\
                      input_is_sda=False, site_name='AERONET_Site', \
-                      df0=None, max_order=1, tmp_plot_path0=None):
+                      df0=None, max_order=1, tmp_plot_path0=None, interp_mode=None, fit_diag=None):
     """
     format aeronet df, interpolate wavelength, ***select the relevant variables
     aeronet_df1: aeronet
@@ -211,11 +261,15 @@ def format_aeronet_df(aeronet_df1, input_wavelengths = [440, 550, 670, 870], \
 
     Todo:
         add aod550 to aeronet data, but the variable is not always available directly
+
+    interp_mode: 'angstrom' interpolate in log-log space, None use max_order (polynomial or spline)
+    fit_diag: collector from get_fit_diagnostics, the spectra are sampled and plotted once at the end,
+        None: plot the interpolation check for this call
     
     """
 
     #note that sometimes for MAN data there is an extra (int) in its variable name, remove it
-    aeronet_df1.columns = aeronet_df1.columns.str.replace(r'\(int\)', '', regex=True)
+    aeronet_df1.columns = list(clean_columns(tuple(aeronet_df1.columns)))
     
     aeronet_df2=pd.DataFrame()
     aeronet_df2['site'] = aeronet_df1[site_name]
@@ -225,17 +279,14 @@ def format_aeronet_df(aeronet_df1, input_wavelengths = [440, 550, 670, 870], \
     ###############################################################################
     if df0 is not None:
         try:
-            wvv2, rrs2 = get_aeronet_oc_rrs(df0, aeronet_df1, key1='Lwn_f/Q[', key2='Exact_Wavelengths(um)_')
-            for i2, wv2 in enumerate(wvv2):
-                aeronet_df1[f'Rrs_f/Q[{np.int32(wv2)}nm]'] = rrs2[:,i2]
-    
-            wvv2, rrs2 = get_aeronet_oc_rrs(df0, aeronet_df1, key1='Lwn_IOP[', key2='Exact_Wavelengths(um)_')
-            for i2, wv2 in enumerate(wvv2):
-                aeronet_df1[f'Rrs_IOP[{np.int32(wv2)}nm]'] = rrs2[:,i2]
-    
-            wvv2, rrs2 = get_aeronet_oc_rrs(df0, aeronet_df1, key1='Lwn[', key2='Exact_Wavelengths(um)_')
-            for i2, wv2 in enumerate(wvv2):
-                aeronet_df1[f'Rrs[{np.int32(wv2)}nm]'] = rrs2[:,i2]
+            #Lwn_f/Q, Lwn_IOP, Lwn converted together, f0 corrected with sun-earth distance of each record
+            r0 = get_earthsun_distance(aeronet_df2['datetime'])
+            wvv2, rrs_dict = get_aeronet_oc_rrs_all(df0, aeronet_df1, key1v=['Lwn_f/Q[', 'Lwn_IOP[', 'Lwn['], \
+                                                    key2='Exact_Wavelengths(um)_', r0=r0)
+            for key1, rrs2 in rrs_dict.items():
+                key3 = key1.replace('Lwn', 'Rrs')
+                for i2, wv2 in enumerate(wvv2):
+                    aeronet_df1[f'{key3}{np.int32(wv2)}nm]'] = rrs2[:,i2]
                 
         except:
             print("convert rrs failed, not aeronet oc case")
@@ -283,7 +334,11 @@ def format_aeronet_df(aeronet_df1, input_wavelengths = [440, 550, 670, 870], \
 
             #interpolate data into new set of wavelength: input_wavelengths
             #original wavelength will be save
-            if(max_order>=0):
+            if(interp_mode=='angstrom'):
+                print("angstrom (log-log) interpolation")
+                aeronet_df2, orig_wavelengths = get_aeronet_fit_angstrom(aeronet_df1, aeronet_df2, input_wavelengths,\
+                                      old_start1=old_start1, old_end1=old_end1, new_start1=new_start1)
+            elif(max_order>=0):
                 print("polynomial interpolation:", max_order)
                 aeronet_df2, orig_wavelengths = get_aeronet_fit_polynomial(aeronet_df1, aeronet_df2, input_wavelengths,\
                                       max_order=max_order, old_start1=old_start1, old_end1=old_end1, new_start1=new_start1)
@@ -292,10 +347,14 @@ def format_aeronet_df(aeronet_df1, input_wavelengths = [440, 550, 670, 870], \
                 aeronet_df2, orig_wavelengths = get_aeronet_fit_spline(aeronet_df1, aeronet_df2, input_wavelengths,\
                                       old_start1=old_start1, old_end1=old_end1, new_start1=new_start1)
 
-            outfile=tmp_plot_path0+'_interpolation_check.png'
-            print("interpolation check plot in:", outfile)
-            check_aeronet_fit(aeronet_df1, orig_wavelengths, aeronet_df2, input_wavelengths,max_order, \
-                              old_start1, old_end1, new_start1, nline=3, outfile=outfile)
+            if fit_diag is not None:
+                add_fit_diagnostics(fit_diag, aeronet_df1, orig_wavelengths, aeronet_df2, input_wavelengths, \
+                                    old_start1, old_end1, new_start1)
+            elif tmp_plot_path0 is not None:
+                outfile=tmp_plot_path0+'_interpolation_check.png'
+                print("interpolation check plot in:", outfile)
+                check_aeronet_fit(aeronet_df1, orig_wavelengths, aeronet_df2, input_wavelengths,max_order, \
+                                  old_start1, old_end1, new_start1, nline=3, outfile=outfile)
         else:
             #no wavelength is involved
             target_cols = [c for c in aeronet_df1.columns \
@@ -348,6 +407,10 @@ def create_datetime_column(df):
             time_col = pattern
             break
     
+    #datetime already parsed (parquet store)
+    if 'datetime' in df.columns and pd.api.types.is_datetime64_any_dtype(df['datetime']):
+        return df['datetime']
+
     if date_col is None or time_col is None:
         raise ValueError(f"Could not find date/time columns. Available columns: {list(df.columns)}")
     
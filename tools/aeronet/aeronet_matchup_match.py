@@ -1,11 +1,12 @@
 
 import re
 import traceback
+from functools import lru_cache
 import numpy as np
 import pandas as pd
 
 import matplotlib.pyplot as plt
-from scipy.interpolate import UnivariateSpline
+from scipy.interpolate import make_interp_spline
 from tools.aeronet_matchup_sda import get_sda_aod
 from tools.aeronet_oc import get_aeronet_oc_rrs
 
@@ -23,17 +24,25 @@ def extract_number(s):
     else:
         return None
 
-def get_aeronet_key(aeronet_df1, old_start1, old_end1):
+@lru_cache(maxsize=None)
+def get_key_pattern(prefix, suffix, anchored=True):
+    """compiled regex for prefix + wavelength (integer or decimal) + suffix"""
+    if anchored:
+        return re.compile(f'^{re.escape(prefix)}(\\d+\\.?\\d*){re.escape(suffix)}$')
+    return re.compile(rf'{re.escape(prefix)}(\d+\.?\d*){re.escape(suffix)}')
+
+@lru_cache(maxsize=256)
+def resolve_aeronet_key(columns, old_start1, old_end1):
     """
-    Get the keys, handles both integer and decimal wavelengths
+    column -> wavelength mapping for a header (tuple of column names)
+    files of the same suite share the header, so the regex is only done once per header
     """
-    # Updated regex to handle decimals: \d+\.?\d*
-    pattern = f'^{re.escape(old_start1)}\\d+\\.?\\d*{re.escape(old_end1)}$'
-    target_cols = [c for c in aeronet_df1.columns 
+    pattern = get_key_pattern(old_start1, old_end1)
+    target_cols = tuple(c for c in columns
                    if c.startswith(old_start1) and c.endswith(old_end1) and
-                   re.match(pattern, c)]
+                   pattern.match(c))
     
-    orig_wavelengths = [extract_number(c) for c in target_cols]
+    orig_wavelengths = tuple(extract_number(c) for c in target_cols)
     
     # Check whether they are numbers
     if are_all_numeric(orig_wavelengths):
@@ -41,26 +50,31 @@ def get_aeronet_key(aeronet_df1, old_start1, old_end1):
     else:
         print("❌ Some values are not numeric")
         print("Non-numeric values:", [w for w in orig_wavelengths if not isinstance(w, (int, float))])
-    
+
     return target_cols, orig_wavelengths
 
+def get_aeronet_key(aeronet_df1, old_start1, old_end1):
+    """
+    Get the keys, handles both integer and decimal wavelengths
+    the result is cached by the column names (see resolve_aeronet_key)
+    """
+    target_cols, orig_wavelengths = resolve_aeronet_key(tuple(aeronet_df1.columns), old_start1, old_end1)
+    return list(target_cols), list(orig_wavelengths)
+
 def are_all_numeric(values):
     """Check if all values are numeric (now expects floats)"""
     return all(isinstance(x, (int, float)) and not np.isnan(x) for x in values if x is not None)
 
 
-def find_closest_wavelength_keys(df, wavelengths, prefix, suffix=''):
-    """
-    Find the closest matching column keys in dataframe for given wavelengths.
-    Handles cases where column names contain decimal numbers.
-    """
-    # Get all columns that match the pattern
-    pattern = rf'{re.escape(prefix)}(\d+\.?\d*){re.escape(suffix)}'
+@lru_cache(maxsize=256)
+def resolve_wavelength_cols(columns, prefix, suffix=''):
+    """columns starting with prefix + wavelength + suffix and their wavelengths, for a header tuple"""
+    pattern = get_key_pattern(prefix, suffix, anchored=False)
     matching_cols = []
     col_wavelengths = []
     
-    for col in df.columns:
-        match = re.match(pattern, col)
+    for col in columns:
+        match = pattern.match(col)
         if match:
             try:
                 wv = float(match.group(1))
@@ -68,6 +82,15 @@ def find_closest_wavelength_keys(df, wavelengths, prefix, suffix=''):
                 col_wavelengths.append(wv)
             except ValueError:
                 continue
+    return tuple(matching_cols), tuple(col_wavelengths)
+
+def find_closest_wavelength_keys(df, wavelengths, prefix, suffix=''):
+    """
+    Find the closest matching column keys in dataframe for given wavelengths.
+    Handles cases where column names contain decimal numbers.
+    """
+    # Get all columns that match the pattern (cached by the column names)
+    matching_cols, col_wavelengths = resolve_wavelength_cols(tuple(df.columns), prefix, suffix)
     
     # Find closest matches for each target wavelength
     col_wavelengths = np.array(col_wavelengths)
@@ -174,12 +197,168 @@ def check_aeronet_fit(aeronet_df1, orig_wavelengths, \
                 print(f"  {req:.1f} -> Not found")
 
     
+def get_fit_diagnostics(nsample=6, seed=0):
+    """
+    collector of the interpolation check: keep a small reservoir sample of
+    (original spectrum, interpolated spectrum) during the run, plot once at the end
+    (plot_fit_diagnostics), rather than a figure for each site and day
+    nsample: number of spectra to keep
+    """
+    return {'nsample': nsample, 'rng': np.random.default_rng(seed), 'nseen': 0, 'samples': []}
+
+def add_fit_diagnostics(fit_diag, aeronet_df1, orig_wavelengths, \
+                        aeronet_df2, input_wavelengths, \
+                        old_start1='AOD_', old_end1='nm', new_start1='aot_wv'):
+    """
+    add the rows of df1 (original) and df2 (interpolated) to the reservoir sample,
+    each row seen so far has the same chance to be kept (reservoir sampling)
+    """
+    n_rows = min(len(aeronet_df1), len(aeronet_df2))
+    if n_rows == 0:
+        return fit_diag
+
+    nsample = fit_diag['nsample']
+    samples = fit_diag['samples']
+
+    #slot of each row in the reservoir, -1 is not kept, later rows replace earlier ones
+    k = fit_diag['nseen'] + np.arange(n_rows)
+    slot = np.where(k < nsample, k, fit_diag['rng'].integers(0, k + 1))
+    slot[slot >= nsample] = -1
+    fit_diag['nseen'] += n_rows
+
+    keep = {}
+    for i1 in np.nonzero(slot >= 0)[0]:
+        keep[slot[i1]] = i1
+    if len(keep) == 0:
+        return fit_diag
+
+    key1v, actual_wv1 = find_closest_wavelength_keys(aeronet_df1, orig_wavelengths, old_start1, old_end1)
+    key2v, actual_wv2 = find_closest_wavelength_keys(aeronet_df2, input_wavelengths, new_start1, '')
+    valid_keys1 = [k1 for k1 in key1v if k1 is not None]
+    valid_wv1 = np.array([w for k1, w in zip(key1v, actual_wv1) if k1 is not None])
+    valid_keys2 = [k2 for k2 in key2v if k2 is not None]
+    valid_wv2 = np.array([w for k2, w in zip(key2v, actual_wv2) if k2 is not None])
+    if len(valid_keys1) == 0 or len(valid_keys2) == 0:
+        return fit_diag
+
+    rows = np.array(list(keep.values()))
+    data1 = aeronet_df1[valid_keys1].to_numpy(dtype=float)[rows]
+    data2 = aeronet_df2[valid_keys2].to_numpy(dtype=float)[rows]
+    for i2, slot1 in enumerate(keep.keys()):
+        sample = (valid_wv1, data1[i2], valid_wv2, data2[i2])
+        if slot1 < len(samples):
+            samples[slot1] = sample
+        else:
+            samples.append(sample)
+
+    return fit_diag
+
+def plot_fit_diagnostics(fit_diag, max_order=None, new_start1='aot_wv', outfile=None):
+    """
+    plot the spectra kept in fit_diag, same figure as check_aeronet_fit
+    """
+    samples = fit_diag['samples'] if fit_diag is not None else []
+    if len(samples) == 0:
+        print("no spectra for the interpolation check")
+        return
+
+    nline = len(samples)
+    plt.figure(figsize=(8,6))
+    colors = plt.cm.tab10(np.linspace(0, 1, nline))
+    for i, (wvv1, data1, wvv2, data2) in enumerate(samples):
+        color = colors[i]
+        plt.plot(wvv1, data1, '.-', color=color, 
+                label=f'original_{i}' if nline > 1 else 'original', alpha=0.8)
+        plt.plot(wvv2, data2, 'o', color=color, markerfacecolor='none', 
+                markersize=6, label=f'fitted_{i}' if nline > 1 else 'fitted', alpha=0.8)
+
+    plt.legend(loc=(1.05,0))
+    plt.xlabel("wavelength")
+    plt.ylabel(new_start1)
+    title_str = f"check fitting, {nline} of {fit_diag['nseen']}"
+    if max_order is not None:
+        title_str += f", max_order: {max_order}"
+    plt.title(title_str)
+    plt.tight_layout()
+
+    if outfile:
+        print("interpolation check plot in:", outfile)
+        plt.savefig(outfile, dpi=300)
+
+    plt.close()
+
+def get_fit_groups(aeronet_df1, target_cols, orig_wavelengths):
+    """
+    group the rows of aeronet_df1 by the set of valid wavelengths (not nan, not -999)
+
+    return a list of (row positions, sorted valid wavelengths, values of these rows (n_rows, n_valid)),
+    the wavelengths are sorted the same way as in the row by row fit
+    """
+    values = aeronet_df1[target_cols].to_numpy(dtype=float)
+    valid = (values != -999) & (~np.isnan(values))
+    wavelengths = np.array(orig_wavelengths)
+
+    groupv = []
+    if values.shape[0] == 0 or values.shape[1] == 0:
+        return groupv
+
+    patterns, inverse = np.unique(valid, axis=0, return_inverse=True)
+    inverse = np.asarray(inverse).reshape(-1)
+    for i1, pattern in enumerate(patterns):
+        rows = np.nonzero(inverse == i1)[0]
+        x_valid = wavelengths[pattern]
+        sort_idx = np.argsort(x_valid)
+        y_valid = values[np.ix_(rows, np.nonzero(pattern)[0])]
+        groupv.append((rows, x_valid[sort_idx], y_valid[:, sort_idx]))
+    return groupv
+
+def fit_polynomial_group(x_sorted, y_sorted, input_wavelengths, max_order=1):
+    """
+    interpolation of all the rows sharing the same sorted valid wavelengths x_sorted,
+    y_sorted: (n_rows, n_valid), two nearby wavelengths are used for each target wavelength:
+    linear (max_order>=1) or the mean of the two values (max_order=0)
+    exact wavelength returns the value, outside the range returns nan
+
+    return (n_rows, n_target)
+    """
+    wv = np.asarray(input_wavelengths, dtype=float)
+    interp = np.full((y_sorted.shape[0], len(wv)), np.nan)
+    if len(x_sorted) < 2:
+        return interp
+
+    in_range = (wv >= x_sorted[0]) & (wv <= x_sorted[-1])
+    idx_right = np.searchsorted(x_sorted, wv)
+    idx_right_c = np.clip(idx_right, 0, len(x_sorted) - 1)
+
+    # wv equals the first, the last, or one of the wavelengths
+    exact = in_range & ((idx_right == 0) | (idx_right >= len(x_sorted)) | (x_sorted[idx_right_c] == wv))
+    exact_idx = np.where(idx_right >= len(x_sorted), len(x_sorted) - 1, idx_right_c)
+    interp[:, exact] = y_sorted[:, exact_idx[exact]]
+
+    # Interpolate between two nearby points
+    between = in_range & ~exact
+    if between.any():
+        idx_r = idx_right[between]
+        idx_l = idx_r - 1
+        x1, x2 = x_sorted[idx_l], x_sorted[idx_r]
+        y1, y2 = y_sorted[:, idx_l], y_sorted[:, idx_r]
+        # Determine polynomial order (max_order or 1, whichever is smaller)
+        if min(max_order, 1) == 1:
+            interp[:, between] = y1 + (y2 - y1) * (wv[between] - x1) / (x2 - x1)
+        else:
+            #0 order polynomial fit of two points
+            interp[:, between] = (y1 + y2)/2
+
+    return interp
+
 def get_aeronet_fit_polynomial(aeronet_df1, aeronet_df2, input_wavelengths, 
                               max_order=1, old_start1='AOD_', old_end1='nm', 
                               new_start1='aot_wv'):
     """
     Interpolate target variable using the two nearby wavelengths for each target wavelength.
     Returns NaN for wavelengths outside the input range.
+
+    rows with the same valid wavelengths are interpolated together (fit_polynomial_group)
     
     Parameters:
     -----------
@@ -188,144 +367,136 @@ def get_aeronet_fit_polynomial(aeronet_df1, aeronet_df2, input_wavelengths,
     """
     
     target_cols, orig_wavelengths = get_aeronet_key(aeronet_df1, old_start1, old_end1)
-    
-    for idx, row in aeronet_df1.iterrows():
-        target_values = row[target_cols].values.astype(float)
-        mask = (target_values != -999) & (~np.isnan(target_values))
-        x_valid = np.array(orig_wavelengths)[mask]
-        y_valid = target_values[mask]
-        
-        if len(x_valid) > 1:
-            # Sort data
-            sort_idx = np.argsort(x_valid)
-            x_valid_sorted = x_valid[sort_idx]
-            y_valid_sorted = y_valid[sort_idx]
-            
-            interp = []
-            
-            for wv in input_wavelengths:
-                # Find the two nearby wavelengths
-                if wv < x_valid_sorted[0] or wv > x_valid_sorted[-1]:
-                    # Outside range
-                    interp.append(np.nan)
-                else:
-                    # Find bracketing wavelengths
-                    idx_right = np.searchsorted(x_valid_sorted, wv)
-                    
-                    if idx_right == 0:
-                        # wv equals the first wavelength
-                        interp.append(y_valid_sorted[0])
-                    elif idx_right >= len(x_valid_sorted):
-                        # wv equals the last wavelength
-                        interp.append(y_valid_sorted[-1])
-                    elif x_valid_sorted[idx_right] == wv:
-                        # Exact match
-                        interp.append(y_valid_sorted[idx_right])
-                    else:
-                        # Interpolate between two nearby points
-                        idx_left = idx_right - 1
-                        x1, x2 = x_valid_sorted[idx_left], x_valid_sorted[idx_right]
-                        y1, y2 = y_valid_sorted[idx_left], y_valid_sorted[idx_right]
-                        
-                        # Determine polynomial order (max_order or 1, whichever is smaller)
-                        poly_order = min(max_order, 1)  # For 2 points, max order is 1
-                        
-                        if poly_order == 1:
-                            # Linear interpolation
-                            interpolated_val = y1 + (y2 - y1) * (wv - x1) / (x2 - x1)
-                        else:
-                            # This case won't occur with 2 points, but keeping for consistency
-                            coeffs = np.polyfit([x1, x2], [y1, y2], poly_order)
-                            poly = np.poly1d(coeffs)
-                            interpolated_val = poly(wv)
-                        
-                        interp.append(interpolated_val)
-            
-            interp = np.array(interp)
-            
-        else:
-            # Not enough points for interpolation
-            interp = np.full(len(input_wavelengths), np.nan)
-        
-        # Store results
-        for wv, val in zip(input_wavelengths, interp):
-            aeronet_df2.at[idx, f'{new_start1}{wv}'] = val
+    if len(aeronet_df1) == 0:
+        return aeronet_df2, orig_wavelengths
+
+    interp = np.full((len(aeronet_df1), len(input_wavelengths)), np.nan)
+    for rows, x_sorted, y_sorted in get_fit_groups(aeronet_df1, target_cols, orig_wavelengths):
+        interp[rows] = fit_polynomial_group(x_sorted, y_sorted, input_wavelengths, max_order=max_order)
+
+    # Store results
+    for i1, wv in enumerate(input_wavelengths):
+        aeronet_df2[f'{new_start1}{wv}'] = pd.Series(interp[:, i1], index=aeronet_df1.index)
     
     return aeronet_df2, orig_wavelengths
 
+def fit_spline_group(x_sorted, y_sorted, input_wavelengths):
+    """
+    interpolating spline (same as UnivariateSpline with s=0) of all the rows sharing the same sorted
+    valid wavelengths x_sorted, y_sorted: (n_rows, n_valid), fitted in one call along axis 1
+    cubic for more than 3 wavelengths, k=2 for 3 and linear for 2, linear interpolation if the fit failed
+    wavelengths outside the range return nan
+
+    return (n_rows, n_target)
+    """
+    wv = np.asarray(input_wavelengths, dtype=float)
+    interp = np.full((y_sorted.shape[0], len(wv)), np.nan)
+    n_valid = len(x_sorted)
+    if n_valid < 2:
+        return interp
+
+    # Apply spline only to wavelengths within range, NaN otherwise
+    in_range = (wv >= x_sorted[0]) & (wv <= x_sorted[-1])
+    if not in_range.any():
+        return interp
+
+    if n_valid > 3:  # Minimum for cubic spline
+        spline = make_interp_spline(x_sorted, y_sorted, k=3, axis=1)
+        interp[:, in_range] = spline(wv[in_range])
+    else:
+        # Fallback to lower order spline, or linear interpolation
+        try:
+            spline = make_interp_spline(x_sorted, y_sorted, k=min(2, n_valid-1), axis=1)
+            interp[:, in_range] = spline(wv[in_range])
+        except Exception:
+            for i1 in range(y_sorted.shape[0]):
+                interp[i1, in_range] = np.interp(wv[in_range], x_sorted, y_sorted[i1])
+
+    return interp
+
 def get_aeronet_fit_spline(aeronet_df1, aeronet_df2, input_wavelengths, \
                            old_start1='AOD_', old_end1='nm', new_start1='aot_wv'):
     """
     Interpolate target variable(such as AOD) from aeronet_df1 at input_wavelengths using cubic spline,
     and assign results to aeronet_df2 as new columns named new_start1+wv.
     Returns NaN for wavelengths outside the input range.
+
+    rows with the same valid wavelengths are fitted together (fit_spline_group)
     """
 
     target_cols, orig_wavelengths = get_aeronet_key(aeronet_df1, old_start1, old_end1)
-                    
-    for idx, row in aeronet_df1.iterrows():
-        target_values = row[target_cols].values.astype(float)
-        mask = (target_values != -999) & (~np.isnan(target_values))
-        x_valid = np.array(orig_wavelengths)[mask]
-        y_valid = target_values[mask]
-
-        # Ensure x_valid is increasing and y_valid is sorted accordingly
-        if len(x_valid) > 1:
-            sort_idx = np.argsort(x_valid)
-            x_valid_sorted = x_valid[sort_idx]
-            y_valid_sorted = y_valid[sort_idx]
-            
-            # Define valid wavelength range
-            x_min, x_max = x_valid_sorted[0], x_valid_sorted[-1]
-        else:
-            x_valid_sorted = x_valid
-            y_valid_sorted = y_valid
-            x_min = x_max = x_valid_sorted[0] if len(x_valid_sorted) > 0 else np.nan
-    
-        if len(x_valid) > 3:  # Minimum for cubic spline
-            spline = UnivariateSpline(x_valid_sorted, y_valid_sorted, k=3, s=0)
-            
-            # Apply spline only to wavelengths within range, NaN otherwise
-            interp = []
-            for wv in input_wavelengths:
-                if x_min <= wv <= x_max:
-                    interp.append(spline(wv))
-                else:
-                    interp.append(np.nan)
-            interp = np.array(interp)
-            
-        elif len(x_valid) > 1:
-            # Fallback to lower order spline, or linear interpolation
-            try:
-                spline = UnivariateSpline(x_valid_sorted, y_valid_sorted, k=min(2, len(x_valid)-1), s=0)
-                
-                # Apply spline only to wavelengths within range, NaN otherwise
-                interp = []
-                for wv in input_wavelengths:
-                    if x_min <= wv <= x_max:
-                        interp.append(spline(wv))
-                    else:
-                        interp.append(np.nan)
-                interp = np.array(interp)
-                
-                print(input_wavelengths, interp, x_valid_sorted, y_valid_sorted)
-            except Exception:
-                # Use linear interpolation with range checking
-                interp = []
-                for wv in input_wavelengths:
-                    if x_min <= wv <= x_max:
-                        interp.append(np.interp(wv, x_valid_sorted, y_valid_sorted))
-                    else:
-                        interp.append(np.nan)
-                interp = np.array(interp)
-        else:
-            interp = np.full(len(input_wavelengths), np.nan)
-            
-        for wv, val in zip(input_wavelengths, interp):
-            aeronet_df2.at[idx, f'{new_start1}{wv}'] = val
+    if len(aeronet_df1) == 0:
+        return aeronet_df2, orig_wavelengths
+
+    interp = np.full((len(aeronet_df1), len(input_wavelengths)), np.nan)
+    groupv = get_fit_groups(aeronet_df1, target_cols, orig_wavelengths)
+    for rows, x_sorted, y_sorted in groupv:
+        interp[rows] = fit_spline_group(x_sorted, y_sorted, input_wavelengths)
+    print("spline fit groups (valid wavelength sets):", len(groupv))
+
+    for i1, wv in enumerate(input_wavelengths):
+        aeronet_df2[f'{new_start1}{wv}'] = pd.Series(interp[:, i1], index=aeronet_df1.index)
         
     return aeronet_df2, orig_wavelengths
 
+def get_aeronet_fit_angstrom(aeronet_df1, aeronet_df2, input_wavelengths, \
+                             old_start1='AOD_', old_end1='nm', new_start1='aot_wv'):
+    """
+    Interpolate AOD-type variables piecewise in log-log space (Angstrom law between the two nearby
+    valid wavelengths):
+        alpha = -ln(y2/y1)/ln(x2/x1), y = y1*(wv/x1)**(-alpha)
+
+    all rows and target wavelengths are done together: the nearby valid wavelengths of each row are
+    found with running max/min of the valid band index, so no loop over rows
+    exact wavelength returns the value, outside the valid range returns nan,
+    linear interpolation is used when the value is not positive (log not defined)
+    """
+    target_cols, orig_wavelengths = get_aeronet_key(aeronet_df1, old_start1, old_end1)
+    if len(aeronet_df1) == 0:
+        return aeronet_df2, orig_wavelengths
+
+    wv = np.asarray(input_wavelengths, dtype=float)
+    interp = np.full((len(aeronet_df1), len(wv)), np.nan)
+
+    if len(target_cols) > 0:
+        x = np.array(orig_wavelengths, dtype=float)
+        sort_idx = np.argsort(x)
+        x = x[sort_idx]
+        values = aeronet_df1[target_cols].to_numpy(dtype=float)[:, sort_idx]
+        valid = (values != -999) & (~np.isnan(values))
+        n_rows, n_bands = values.shape
+
+        #index of the last valid band at or before each band, and the first valid band at or after it
+        band = np.arange(n_bands)
+        last_valid = np.maximum.accumulate(np.where(valid, band, -1), axis=1)
+        next_valid = np.minimum.accumulate(np.where(valid, band, n_bands)[:, ::-1], axis=1)[:, ::-1]
+
+        #band position of each target wavelength (same for all rows)
+        pos_lo = np.searchsorted(x, wv, side='right') - 1
+        pos_hi = np.searchsorted(x, wv, side='left')
+        i_lo = np.where(pos_lo >= 0, last_valid[:, np.clip(pos_lo, 0, n_bands-1)], -1)
+        i_hi = np.where(pos_hi < n_bands, next_valid[:, np.clip(pos_hi, 0, n_bands-1)], n_bands)
+        found = (i_lo >= 0) & (i_hi < n_bands)
+
+        rows = np.arange(n_rows)[:, None]
+        i_lo_c = np.clip(i_lo, 0, n_bands-1)
+        i_hi_c = np.clip(i_hi, 0, n_bands-1)
+        x1, x2 = x[i_lo_c], x[i_hi_c]
+        y1, y2 = values[rows, i_lo_c], values[rows, i_hi_c]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            exact = found & (x1 == wv)
+            use_log = found & ~exact & (y1 > 0) & (y2 > 0) & (x1 > 0)
+            y_log = np.exp(np.log(y1) + (np.log(y2) - np.log(y1))*(np.log(wv) - np.log(x1))/(np.log(x2) - np.log(x1)))
+            y_lin = y1 + (y2 - y1)*(wv - x1)/(x2 - x1)
+
+        interp = np.where(exact, y1, np.where(use_log, y_log, np.where(found, y_lin, np.nan)))
+
+    for i1, wv1 in enumerate(input_wavelengths):
+        aeronet_df2[f'{new_start1}{wv1}'] = pd.Series(interp[:, i1], index=aeronet_df1.index)
+
+    return aeronet_df2, orig_wavelengths
+
 def subset_pace_df(pace_df_mean_all, pace_df_std_all, all_vars, extra_vars):
     """
     format pace dataframe, selecting subset of variables
@@ -353,76 +524,131 @@ def match_time_aeronet(pace_df_mean_all, pace_df_std_all, aeronet_df2, site_to_m
     Includes average matched aeronet time as 'datetime_aeronet'.
     Filters out entries with count=0 or all NaN values.
     Also filters input dataframes to match output structure.
+
+    interval join: the aeronet times of the site are sorted once, the window of each pace time is
+    found by searchsorted, and mean, std (ddof=1, as pandas), count and average time of all the
+    windows come from cumulative sums
+    """
+    return match_time_aeronet_sites(pace_df_mean_all, pace_df_std_all, aeronet_df2, [site_to_match], \
+                                    delta_hour=delta_hour)
+
+def match_time_aeronet_sites(pace_df_mean_all, pace_df_std_all, aeronet_df2, site1v, delta_hour=1):
+    """
+    match_time_aeronet for all the sites in site1v in one pass
+
+    the rows are sorted by the composite key (site code, time), so the window
+    [ts - delta_hour, ts + delta_hour] of every pace row is searched within its own site,
+    output rows are in the order of site1v, then in the order of the pace rows
+    (same as concatenating match_time_aeronet site by site)
     """
     time_window = pd.Timedelta(hours=delta_hour)
-    df_pace = pace_df_mean_all[pace_df_mean_all['site'] == site_to_match].copy()
+    site_code = {site1: i1 for i1, site1 in enumerate(dict.fromkeys(site1v))}
     data_vars = [c for c in aeronet_df2.columns if c not in ['site', 'datetime']]
 
-    mean_rows = []
-    std_rows = []
-
-    for ts in df_pace['datetime']:
-        mask = (
-            (aeronet_df2['site'] == site_to_match) &
-            (aeronet_df2['datetime'] >= ts - time_window) &
-            (aeronet_df2['datetime'] <= ts + time_window)
-        )
-
-        matched_aeronet = aeronet_df2.loc[mask, data_vars + ['datetime']]
-        matched_aeronet = matched_aeronet.replace(-999, np.nan)
-        means = matched_aeronet[data_vars].mean(axis=0)
-        stds = matched_aeronet[data_vars].std(axis=0)
-        num_timestamps = matched_aeronet['datetime'].count()
-        
-        # Skip if no matches or all data values are NaN
-        if num_timestamps == 0 or means.isna().all():
-            continue
-        
-        # Compute average datetime if there are matches
-        avg_aeronet_time = matched_aeronet['datetime'].mean()
-        avg_aeronet_time = pd.to_datetime(avg_aeronet_time)
-        
-        mean_row = {
-            'datetime': ts,
-            'site': site_to_match,
-            'count': num_timestamps,
-            'datetime_aeronet': avg_aeronet_time
-        }
-        
-        mean_row.update({var: means[var] for var in means.index})
-        
-        std_row = {
-            'datetime': ts,
-            'site': site_to_match,
-            'count': num_timestamps,
-            'datetime_aeronet': avg_aeronet_time
-        }
-        std_row.update({var: stds[var] for var in stds.index})
-        
-        mean_rows.append(mean_row)
-        std_rows.append(std_row)
+    def select_sites(df):
+        """rows of the sites in site1v, in the order of site1v (stable)"""
+        code = df['site'].map(site_code)
+        df = df.loc[code.notna().values]
+        code = code[code.notna()].to_numpy(dtype=np.int64)
+        order = np.argsort(code, kind='stable')
+        return df.iloc[order], code[order]
 
-    aeronet_df3_mean = pd.DataFrame(mean_rows)
-    aeronet_df3_std = pd.DataFrame(std_rows)
-    
-    # Filter input dataframes to match the structure of aeronet_df3_mean and aeronet_df3_std
-    if not aeronet_df3_mean.empty:
-        # Get the datetime values that exist in aeronet_df3_mean/aeronet_df3_std
-        valid_datetimes = aeronet_df3_mean['datetime'].unique()
-        
-        # Filter pace_df_mean_all and pace_df_std_all to match
-        pace_df_mean_all_filtered = pace_df_mean_all[
-            (pace_df_mean_all['site'] == site_to_match) & 
-            (pace_df_mean_all['datetime'].isin(valid_datetimes))
-        ].copy()
-        
-        pace_df_std_all_filtered = pace_df_std_all[
-            (pace_df_std_all['site'] == site_to_match) & 
-            (pace_df_std_all['datetime'].isin(valid_datetimes))
-        ].copy()
+    df_pace, pace_codes = select_sites(pace_df_mean_all)
+
+    aeronet_site, aeronet_codes = select_sites(aeronet_df2.loc[aeronet_df2['datetime'].notna(), \
+                                                               ['site'] + data_vars + ['datetime']])
+    times = aeronet_site['datetime'].values
+    pace_times = df_pace['datetime'].values
+    window_ns = int(time_window.value)
+
+    if len(times) > 0:
+        #composite key: code*span + time in ns since the first aeronet time
+        t0 = times.min()
+        rel_times = (times - t0).astype('timedelta64[ns]').astype(np.int64)
+        span = int(rel_times.max()) + 1
+        if len(site_code)*span >= 2**62:
+            #period too long for the composite key, match site by site
+            resultv = [match_time_aeronet_sites(pace_df_mean_all, pace_df_std_all, aeronet_df2, [site1], \
+                                                delta_hour=delta_hour) for site1 in site_code]
+            return tuple(pd.concat([result[i] for result in resultv], ignore_index=True) for i in range(4))
+
+        order = np.lexsort((rel_times, aeronet_codes))
+        aeronet_site = aeronet_site.iloc[order]
+        times = times[order]
+        keys = aeronet_codes[order]*span + rel_times[order]
+
+        pace_rel = (pace_times - t0).astype('timedelta64[ns]').astype(np.int64)
+        key_lo = pace_codes*span + np.clip(pace_rel - window_ns, 0, span - 1)
+        key_hi = pace_codes*span + np.clip(pace_rel + window_ns, 0, span - 1)
+        lo = np.searchsorted(keys, key_lo, side='left')
+        hi = np.searchsorted(keys, key_hi, side='right')
+        #windows before the first or after the last aeronet time, and nat pace time: no match
+        no_match = (pace_rel + window_ns < 0) | (pace_rel - window_ns >= span) | pd.isna(pace_times)
+        hi = np.where(no_match, lo, hi)
     else:
-        # If no valid matches, return empty dataframes with same structure
-        pace_df_mean_all_filtered = pace_df_mean_all[pace_df_mean_all['site'] == site_to_match].iloc[0:0].copy()
-        pace_df_std_all_filtered = pace_df_std_all[pace_df_std_all['site'] == site_to_match].iloc[0:0].copy()
+        lo = np.zeros(len(pace_times), dtype=np.int64)
+        hi = lo.copy()
+    num_timestamps = hi - lo
+
+    #copy: to_numpy can return a read only view (pandas copy on write)
+    values = aeronet_site[data_vars].to_numpy(dtype=float, copy=True)
+    values[values == -999] = np.nan
+    valid = ~np.isnan(values)
+
+    #shift by the column mean to keep the sum of squares accurate
+    n_valid = valid.sum(axis=0)
+    shift = np.where(n_valid > 0, np.nansum(values, axis=0)/np.maximum(n_valid, 1), 0)
+    values0 = np.where(valid, values - shift, 0)
+
+    def window_sum(arr):
+        csum = np.concatenate((np.zeros((1,) + arr.shape[1:]), np.cumsum(arr, axis=0)))
+        return csum[hi] - csum[lo]
+
+    n = window_sum(valid.astype(float))
+    s1 = window_sum(values0)
+    s2 = window_sum(values0**2)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(n > 0, s1/n, np.nan)
+        var = np.where(n > 1, (s2 - s1*s1/n)/(n - 1), np.nan)
+        stds = np.sqrt(np.clip(var, 0, None))
+        means = means + shift
+
+        #average time, relative to the first aeronet time
+        if len(times) > 0:
+            dt = (times - t0).astype('timedelta64[ns]').astype(np.int64).astype(float)
+            t_sum = np.concatenate(([0.0], np.cumsum(dt)))
+            avg_dt = (t_sum[hi] - t_sum[lo])/np.where(num_timestamps > 0, num_timestamps, 1)
+            avg_aeronet_time = t0 + np.round(avg_dt).astype(np.int64).astype('timedelta64[ns]')
+        else:
+            avg_aeronet_time = np.full(len(pace_times), np.datetime64('NaT', 'ns'))
+
+    # Skip if no matches or all data values are NaN
+    keep = (num_timestamps > 0) & ~np.all(np.isnan(means), axis=1)
+
+    if keep.any():
+        columns = {'datetime': pace_times[keep],
+                   'site': df_pace['site'].values[keep],
+                   'count': num_timestamps[keep],
+                   'datetime_aeronet': avg_aeronet_time[keep]}
+        aeronet_df3_mean = pd.DataFrame(columns)
+        aeronet_df3_std = pd.DataFrame(columns)
+        aeronet_df3_mean = pd.concat([aeronet_df3_mean, pd.DataFrame(means[keep], columns=data_vars)], axis=1)
+        aeronet_df3_std = pd.concat([aeronet_df3_std, pd.DataFrame(stds[keep], columns=data_vars)], axis=1)
+    else:
+        aeronet_df3_mean = pd.DataFrame()
+        aeronet_df3_std = pd.DataFrame()
+
+    # Filter input dataframes to match the structure of aeronet_df3_mean and aeronet_df3_std
+    # keep the pace rows of the matched (site, datetime)
+    valid_pairs = pd.MultiIndex.from_arrays([df_pace['site'].values[keep], pace_times[keep]])
+
+    def filter_pace(df):
+        df, code = select_sites(df)
+        pairs = pd.MultiIndex.from_arrays([df['site'].values, df['datetime'].values])
+        return df.loc[pairs.isin(valid_pairs)].copy()
+
+    pace_df_mean_all_filtered = filter_pace(pace_df_mean_all)
+    pace_df_std_all_filtered = filter_pace(pace_df_std_all)
 
-    return aeronet_df3_mean, aeronet_df3_std, pace_df_mean_all_filtered, pace_df_std_all_filtered
\ No newline at end of file
+    return aeronet_df3_mean, aeronet_df3_std, pace_df_mean_all_filtered, pace_df_std_all_filtered
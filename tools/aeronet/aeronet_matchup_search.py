@@ -1,8 +1,10 @@
-import re
 import os
 import math
 import time
 import traceback
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 from tqdm import tqdm
 import xarray as xr
@@ -16,6 +18,9 @@ import matplotlib.pyplot as plt
 import cartopy
 import cartopy.crs as ccrs
 
+from tools.narwhal_granule import read_geolocation
+from tools.narwhal_footprint import select_granules, lonlat_to_xyz, R_EARTH
+
 def plot_search(indexvv, boundingboxv, outfile=None):
     """
     plot the global map with candicate matchup pixels
@@ -94,15 +99,80 @@ def check_netcdf_file(nc_path):
         traceback.print_exc()
         return False 
         
+def match_granule(datetime1, lon_pace, lat_pace, lon_loc, lat_loc, namev, search_center_radius=10, match_mode='batch', \
+                  kdtree_workers=-1):
+    """
+    find the sites in the lon/lat of one granule with the search method of match_mode
+    kdtree_workers: threads of the kdtree query (-1: all the cpus, 1 inside the worker processes)
+    """
+    if(match_mode=='loop'):
+        return get_match(datetime1, lon_pace, lat_pace, lon_loc, lat_loc, namev, \
+                         search_center_radius = search_center_radius)
+    elif(match_mode=='ecef'):
+        return get_match_ecef(datetime1, lon_pace, lat_pace, lon_loc, lat_loc, namev, \
+                              search_center_radius = search_center_radius, kdtree_workers=kdtree_workers)
+    else:
+        return get_match_batch(datetime1, lon_pace, lat_pace, lon_loc, lat_loc, namev, \
+                               search_center_radius = search_center_radius, kdtree_workers=kdtree_workers)
+
+def search_granule(nc_path, lon_loc, lat_loc, namev, search_center_radius=10, match_mode='batch', kdtree_workers=-1):
+    """
+    search the validation sites in one granule, also used by the worker processes
+
+    return datetime1, indexv, boundingbox, or None if the granule failed
+    """
+    try:
+        #dataset = xr.open_datatree(nc_path, group='geolocation_data')
+        #dataset = xr.open_dataset(nc_path, group='geolocation_data')
+
+        #only read lon and lat with netCDF4, no need to merge all the groups in the datatree
+        lon_variable, lat_variable, datetime1 = read_geolocation(nc_path)
+        boundingbox = get_boundingbox(lon_variable, lat_variable)
+
+        indexv = match_granule(datetime1, lon_variable, lat_variable, lon_loc, lat_loc, namev, \
+                               search_center_radius=search_center_radius, match_mode=match_mode, \
+                               kdtree_workers=kdtree_workers)
+        return datetime1, indexv, boundingbox
+
+    except Exception as e:
+        print(f"  Error searching path {nc_path}: {str(e)}")
+        print("  Full traceback:")
+        traceback.print_exc()
+        return None
+
+def map_granules(func, filev, n_workers=1):
+    """
+    apply func to each granule, in worker processes if n_workers>1
+    results are returned in the order of filev
+    """
+    if(n_workers is None or n_workers<=1 or len(filev)<=1):
+        return [func(nc_path) for nc_path in tqdm(filev)]
+
+    n_workers = min(n_workers, len(filev))
+    print("number of worker processes:", n_workers)
+    #spawn: do not fork the parent with open netcdf/hdf5 handles
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return list(tqdm(executor.map(func, filev), total=len(filev)))
+
 def aeronet_search(aeronet_df1, filev, search_center_radius = 10, \
                    aeronet_lon_var='Longitude(decimal_degrees)', aeronet_lat_var='Latitude(decimal_degrees)', \
-                   aeronet_site_var='Site_Name'):
+                   aeronet_site_var='Site_Name', match_mode='batch', footprint_db=None, n_workers=1):
     """
     search validation site location from the l2 granules:
     validation data structure may be used for other data such as pace_pax and earthcare,
     make the variable name flexible.
 
     filev is the l2 pace data, the variable names are fixed, no need to modify
+
+    match_mode:
+        'batch': query all the sites in one kdtree call (get_match_batch)
+        'loop': original site by site search (get_match)
+        'ecef': kdtree on the unit sphere, radius in great circle distance (get_match_ecef)
+
+    footprint_db: sqlite file of granule footprints, if given, skip the granules
+        without any site within search_center_radius before building the kdtree
+
+    n_workers: number of processes to search the granules (1: in the current process)
     """
     locv = aeronet_df1[[aeronet_lon_var,aeronet_lat_var]].to_numpy()
     lon_loc, lat_loc = locv[:,0], locv[:,1]
@@ -110,38 +180,24 @@ def aeronet_search(aeronet_df1, filev, search_center_radius = 10, \
     
     
     t1=time.time()
+
+    if(footprint_db):
+        filev = select_granules(filev, lon_loc, lat_loc, search_center_radius, footprint_db)
     
     indexvv={}
     boundingboxv={}
-    
-    for nc_path in tqdm(filev[:]):
-        
-        #print("***nc path:", nc_path)
-        #check_netcdf_file(nc_path)
 
-        try:
-            datetime1 = re.search(r'(\d{8}T\d{6})', nc_path).group(1)
-            #dataset = xr.open_datatree(nc_path, group='geolocation_data')
-            #dataset = xr.open_dataset(nc_path, group='geolocation_data')
+    #one kdtree thread in each worker process, the processes already use the cpus
+    kdtree_workers = 1 if (n_workers is not None and n_workers > 1) else -1
+    func = partial(search_granule, lon_loc=lon_loc, lat_loc=lat_loc, namev=namev, \
+                   search_center_radius=search_center_radius, match_mode=match_mode, kdtree_workers=kdtree_workers)
 
-            #use datatree instead of dataset to avoid mixing configuration of xarray
-            datatree = xr.open_datatree(nc_path, decode_timedelta=False)
-            dataset = xr.merge(datatree.to_dict().values())
-        
-            lon_variable = dataset['longitude'].values
-            lat_variable = dataset['latitude'].values
-            lons, lats = get_boundingbox(lon_variable, lat_variable)
-            boundingboxv[datetime1]=[lons, lats]
-
-            #print("load lat and lon from nc file")
-            
-            indexv = get_match(datetime1, lon_variable, lat_variable, lon_loc, lat_loc, namev, search_center_radius = search_center_radius)
-            indexvv[datetime1]=indexv
-
-        except Exception as e:
-            print(f"  Error searching path {nc_path}: {str(e)}")
-            print("  Full traceback:")
-            traceback.print_exc()
+    for result in map_granules(func, filev[:], n_workers=n_workers):
+        if result is None:
+            continue
+        datetime1, indexv, boundingbox = result
+        boundingboxv[datetime1]=boundingbox
+        indexvv[datetime1]=indexv
         
     t2=time.time()
     print("total time cost", t2-t1)
@@ -180,6 +236,25 @@ def haversine(loc1, loc2):
 
     return distance
     
+def haversine_np(lon1, lat1, lon2, lat2):
+    """
+    vectorized haversine distance in km, same as haversine() for numpy arrays
+    """
+    R = 6371.0
+
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+    return R * c
+
+def get_dis_np(lon1, lat1, lon2, lat2):
+    """vectorized get_dis, distance in km with a straight line in degree"""
+    return np.sqrt((lon1-lon2)**2+(lat1-lat2)**2)*110
+
 def get_kdtree(lon_pace, lat_pace):
     """construct kdtree"""
     
@@ -255,6 +330,119 @@ def get_match(datetime1, lon_pace, lat_pace, lon_aeronet, lat_aeronet, namev, se
     
     return indexv
 
+def get_match_batch(datetime1, lon_pace, lat_pace, lon_aeronet, lat_aeronet, namev, search_center_radius = 5, \
+                    kdtree_workers=-1):
+    """
+    same as get_match, but all the sites are searched with one kdtree query,
+    and the distances are computed as arrays
+
+    the kdtree search is bounded by search_center_radius (converted to degree by /110km),
+    sites without a pixel inside the radius are dropped directly by the query
+
+    output: the same list of dict as get_match, in the order of the sites
+    """
+    kdtree = get_kdtree(lon_pace, lat_pace)
+
+    lon_aeronet = np.asarray(lon_aeronet, dtype=float)
+    lat_aeronet = np.asarray(lat_aeronet, dtype=float)
+    target_points = np.column_stack((lon_aeronet, lat_aeronet))
+
+    #nextafter: keep the pixels right at the radius, same as dis0<=search_center_radius in get_match
+    upper_bound = np.nextafter(search_center_radius/110, np.inf)
+    dis0, indices = kdtree.query(target_points, distance_upper_bound=upper_bound, workers=kdtree_workers)
+    dis0 = dis0*110
+
+    #missing neighbors are returned with inf distance and index n
+    valid = np.isfinite(dis0) & (dis0<=search_center_radius)
+    site_indexv = np.nonzero(valid)[0]
+
+    line_index, pixel_index = np.unravel_index(indices[valid], lat_pace.shape)
+    lon_new = lon_pace[line_index, pixel_index]
+    lat_new = lat_pace[line_index, pixel_index]
+    lon_target = lon_aeronet[valid]
+    lat_target = lat_aeronet[valid]
+
+    #use float64 as in the scalar version
+    dis1v = haversine_np(lon_target, lat_target, lon_new.astype(float), lat_new.astype(float)) #real distance
+    dis2v = get_dis_np(lon_target, lat_target, lon_new.astype(float), lat_new.astype(float)) #estimated distance with straight line
+    dis0v = dis0[valid]
+
+    indexv=[]
+    for j1, i1 in enumerate(site_indexv):
+        data1 = {'site_index':i1, 'site':namev[i1],'pace_date': datetime1, \
+                 'pace_loc_index':(line_index[j1], pixel_index[j1]),\
+                 'distance0_kdtree':dis0v[j1], 'distance1_haversine':dis1v[j1], 'distance2_euclidean':dis2v[j1], \
+                 'aeronet_loc':target_points[i1], 'pace_loc':[lon_new[j1], lat_new[j1]]}
+        indexv.append(data1)
+
+    return indexv
+
+def get_kdtree_ecef(lon_pace, lat_pace):
+    """
+    construct kdtree with the 3d unit vectors (ECEF on unit sphere) of the valid pixels
+    also return the flat index of these pixels in lon_pace
+    """
+    flat_lons = lon_pace.flatten()
+    flat_lats = lat_pace.flatten()
+
+    valid = np.isfinite(flat_lons) & np.isfinite(flat_lats)
+    flat_index = np.nonzero(valid)[0]
+
+    kdtree = cKDTree(lonlat_to_xyz(flat_lons[valid], flat_lats[valid]))
+    return kdtree, flat_index
+
+def get_match_ecef(datetime1, lon_pace, lat_pace, lon_aeronet, lat_aeronet, namev, search_center_radius = 5, \
+                   kdtree_workers=-1):
+    """
+    same output as get_match, but search on the unit sphere:
+    search_center_radius in km is converted to the chord length 2*sin(d/2R),
+    so the radius is a true great circle distance at all latitudes and across the antimeridian
+
+    all the pixels within the chord radius are found with query_ball_point (all sites in one call),
+    and kept in 'pace_loc_index_radius' (line and pixel index arrays), the entry of the site is centered
+    on the nearest of them (pace_loc_index, pace_loc, distances), as the one pixel of get_match
+    distance0_kdtree is the great circle distance from the chord
+    """
+    kdtree, flat_index = get_kdtree_ecef(lon_pace, lat_pace)
+
+    lon_aeronet = np.asarray(lon_aeronet, dtype=float)
+    lat_aeronet = np.asarray(lat_aeronet, dtype=float)
+    target_points = np.column_stack((lon_aeronet, lat_aeronet))
+    xyz_target = lonlat_to_xyz(lon_aeronet, lat_aeronet)
+
+    chord_radius = np.nextafter(2*np.sin(search_center_radius/(2*R_EARTH)), np.inf)
+    #sites without coordinates are never matched
+    site_valid = np.nonzero(np.all(np.isfinite(xyz_target), axis=1))[0]
+    ballv = kdtree.query_ball_point(xyz_target[site_valid], r=chord_radius, workers=kdtree_workers) \
+        if len(site_valid) > 0 else []
+
+    indexv=[]
+    for i1, ball in zip(site_valid, ballv):
+        if len(ball) == 0:
+            continue
+        ball = np.asarray(ball)
+        chord = np.linalg.norm(kdtree.data[ball] - xyz_target[i1], axis=1)
+        #nearest pixel, the lowest pixel index for equal distances
+        k1 = np.lexsort((flat_index[ball], chord))[0]
+
+        line_ball, pixel_ball = np.unravel_index(flat_index[ball], lat_pace.shape)
+        line1, pixel1 = line_ball[k1], pixel_ball[k1]
+        lon_new = lon_pace[line1, pixel1]
+        lat_new = lat_pace[line1, pixel1]
+
+        dis0 = 2*R_EARTH*np.arcsin(np.clip(chord[k1]/2, 0, 1))
+        dis1 = haversine_np(lon_aeronet[i1], lat_aeronet[i1], float(lon_new), float(lat_new))
+        dis2 = get_dis_np(lon_aeronet[i1], lat_aeronet[i1], float(lon_new), float(lat_new))
+
+        data1 = {'site_index':i1, 'site':namev[i1],'pace_date': datetime1, \
+                 'pace_loc_index':(line1, pixel1),\
+                 'distance0_kdtree':dis0, 'distance1_haversine':dis1, 'distance2_euclidean':dis2, \
+                 'aeronet_loc':target_points[i1], 'pace_loc':[lon_new, lat_new], \
+                 'pace_loc_index_radius':(line_ball, pixel_ball)}
+        indexv.append(data1)
+
+    return indexv
+
 def get_boundingbox(lon, lat):
     lons = [lon[0,0], lon[0,-1], lon[-1,-1], lon[-1,0], lon[0,0]]
     lats = [lat[0,0], lat[0,-1], lat[-1,-1], lat[-1,0], lat[0,0]]
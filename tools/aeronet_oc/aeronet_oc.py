@@ -1,19 +1,34 @@
 """
 read original df0 file: df0=get_f0_tsis(f0_file)
 read integrated df0 file: df0=pd.read_csv(f0_file,index_col=0)
+
+band integrated f0 is cached by (bandwidth, wavelengths, spectrum checksum), see get_df0_avg
 """
+import sys
+import hashlib
 import numpy as np
 import pandas as pd
 import pvlib.solarposition as sunpos
 
+#integrated f0 table for each (bandwidth, wavelengths, spectrum checksum)
+F0_CACHE = {}
+
+def get_f0_checksum(df0):
+    """checksum of the f0 spectrum, used in the key of F0_CACHE"""
+    values = np.ascontiguousarray(df0[['wv', 'f0']].to_numpy(dtype=float))
+    return hashlib.md5(values.tobytes()).hexdigest()
+
 def get_df0_avg(df0, time=None, bandwidth=10, \
         wvv2=[340,  380,  400,  412,  440,  443,  490,  500,  510,  531,  532,
-        551,  555,  560,  620,  667,  675,  681,  709,  779,  865,  870, 1020]):
+        551,  555,  560,  620,  667,  675,  681,  709,  779,  865,  870, 1020], outfile=None):
     """
     get df0 with integration over all the aeronet oc bands in the file (some may be not used
     wvv2 are all the wavelength get from aeronet oc files
 
     correct for sun-earth distance, need verify with the l1c file attribute
+
+    the integration is cached by (bandwidth, wvv2, spectrum checksum), so it is done once per run
+    outfile: save the table, e.g. f'f0_tsis_aeronet_oc_bw{bandwidth}.csv', None: not saved
     """
 
     #path5='/mnt/mfs/mgao1/develop/aeronet/aeronet_val01/data/aeronet_data/LWN15/'
@@ -21,24 +36,55 @@ def get_df0_avg(df0, time=None, bandwidth=10, \
     #wvv2=get_aeronet_oc_wv(path5+file5)
     
     bvv2 = np.repeat(bandwidth, len(wvv2))
-    
-    f0avg2, stats2 = trapezoidal_mean_in_bands(df0, wvv2, bvv2)
+
+    key = (bandwidth, tuple(np.asarray(wvv2).tolist()), get_f0_checksum(df0))
+    if key not in F0_CACHE:
+        f0avg2, stats2 = trapezoidal_mean_in_bands(df0, wvv2, bvv2)
+        F0_CACHE[key] = f0avg2
+    f0avg2 = F0_CACHE[key]
     
     df2=pd.DataFrame()
     df2['wv']=wvv2
     df2['bv']=bvv2
     if time is not None:
-        time_index = pd.to_datetime([time])
-        r0 = sunpos.nrel_earthsun_distance(time_index)
+        r0 = get_earthsun_distance([time])[0]
         df2['f0']=f0avg2/r0**2
-        print("sun earth distance {r0} at {time}")
+        print(f"sun earth distance {r0} at {time}")
     else:
         df2['f0']=f0avg2
-        
-    df2.to_csv(f'f0_tsis_aeronet_oc_bw{bandwidth}.csv')
+
+    if outfile is not None:
+        df2.to_csv(outfile)
     
     return df2
     
+#sun-earth distance (AU) for each day (at noon UTC)
+EARTHSUN_CACHE = {}
+
+def get_earthsun_distance(datetimes):
+    """
+    sun-earth distance (AU) for all the datetimes (UTC), one value per day,
+    the days not computed before are done in one pvlib call and kept in EARTHSUN_CACHE
+
+    return array with the same length as datetimes, nan for missing time
+    """
+    days = pd.DatetimeIndex(pd.to_datetime(datetimes)).normalize()
+    if days.tz is not None:
+        days = days.tz_convert('UTC').tz_localize(None)
+
+    valid = ~days.isna()
+    day_values, inverse = np.unique(days[valid].values, return_inverse=True)
+    day_index = pd.DatetimeIndex(day_values)
+
+    missing = [day1 for day1 in day_index if day1 not in EARTHSUN_CACHE]
+    if len(missing) > 0:
+        r0v = np.asarray(sunpos.nrel_earthsun_distance(pd.DatetimeIndex(missing) + pd.Timedelta(hours=12)))
+        EARTHSUN_CACHE.update(zip(missing, r0v))
+
+    r0 = np.full(len(days), np.nan)
+    r0[valid] = np.array([EARTHSUN_CACHE[day1] for day1 in day_index])[inverse]
+    return r0
+
 def get_aeronet_oc_wv(file):
     
     df5=pd.read_csv(file, skiprows=5)
@@ -96,6 +142,48 @@ def get_aeronet_oc_rrs(df0, df3, key1='Lwn_f/Q[', key2='Exact_Wavelengths(um)_')
     rrs2 = lwn1/f0avg2
 
     return wvv2, rrs2
+
+def get_aeronet_oc_rrs_all(df0, df3, key1v=['Lwn_f/Q[', 'Lwn_IOP[', 'Lwn['], \
+                           key2='Exact_Wavelengths(um)_', r0=None):
+    """
+    Rrs = Lwn/F0 for all the Lwn types together (same as get_aeronet_oc_rrs for each key1),
+    the Lwn columns are stacked and divided by f0 in one step
+
+    r0: sun-earth distance (AU) of each row, f0 is corrected as f0/r0**2, None: no correction
+
+    return wvv2, and a dict key1 -> rrs (nrow, nwv), the key1 without valid columns are skipped
+    """
+    df3 = df3.replace(-999, np.nan)
+    df3 = df3.dropna(axis=1, how='all')
+
+    #at the selected wavelength
+    key2v = get_aeronet_oc_key(key2, df3)
+    wvv2 = np.array([np.int32(keyt.split(key2)[1]) for keyt in key2v])
+
+    f0avg2 = df0[df0['wv'].isin(wvv2)]['f0'].values
+
+    key1v2 = []
+    colv = []
+    for key1 in key1v:
+        cols = get_aeronet_oc_key(key1, df3)
+        if len(cols) == len(f0avg2) and len(cols) > 0:
+            key1v2.append(key1)
+            colv.extend(cols)
+        else:
+            print(f"****aeronet oc {key1} wavelength do not match f0: {len(cols)}, {len(f0avg2)}")
+
+    if len(key1v2) == 0:
+        return wvv2, {}
+
+    nwv = len(f0avg2)
+    f0_all = np.tile(f0avg2, len(key1v2))
+    rrs_all = df3[colv].to_numpy(dtype=float)/f0_all
+    if r0 is not None:
+        rrs_all = rrs_all*(np.asarray(r0, dtype=float)**2)[:, None]
+
+    rrs_dict = {key1: rrs_all[:, i1*nwv:(i1+1)*nwv] for i1, key1 in enumerate(key1v2)}
+
+    return wvv2, rrs_dict
     
 def get_aeronet_oc_key(key2, df3):
     """
@@ -140,45 +228,59 @@ def trapezoidal_mean_in_bands(df0, wvv, bvv):
     """
     Calculate mean f0 values using trapezoidal integration method
     Mean = Integrated_area / bandwidth
+
+    all the bands are done together with the cumulative trapezoidal integral of the spectrum:
+    area of a band = cumulative integral at the last point in the band - at the first point
+
+    non-finite f0 is masked out of the cumulative sums, so it only gives nan in its own band (as np.trapz)
     """
-    mean_values = []
-    band_info = []
+    df0 = df0.sort_values('wv')
+    x = df0['wv'].to_numpy(dtype=float)
+    y = df0['f0'].to_numpy(dtype=float)
+
+    # points without a wavelength are in no band
+    valid_x = np.isfinite(x)
+    x, y = x[valid_x], y[valid_x]
+
+    bad = ~np.isfinite(y)
+    y = np.where(bad, 0.0, y)
+    cum = np.concatenate(([0.0], np.cumsum(0.5*(y[1:] + y[:-1])*np.diff(x))))
+    # number of non-finite points before each index
+    cum_bad = np.concatenate(([0], np.cumsum(bad)))
+
+    center_wv = np.asarray(wvv, dtype=float)
+    bandwidth = np.asarray(bvv, dtype=float)
+    # Define band edges
+    wv_min = center_wv - bandwidth / 2
+    wv_max = center_wv + bandwidth / 2
+
+    # first and last point within each band
+    i_lo = np.searchsorted(x, wv_min, side='left')
+    i_hi = np.searchsorted(x, wv_max, side='right') - 1
+    n_points = np.maximum(i_hi - i_lo + 1, 0)
+
+    i_lo_c = np.clip(i_lo, 0, len(x) - 1)
+    i_hi_c = np.clip(i_hi, 0, len(x) - 1)
+    integrated_area = cum[i_hi_c] - cum[i_lo_c]
+    actual_width = x[i_hi_c] - x[i_lo_c]
+
+    # several points: trapezoidal mean, single point: that value, no data in band: nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_values = np.where(n_points > 1, integrated_area / actual_width, np.nan)
+    mean_values = np.where(n_points == 1, y[i_lo_c], mean_values)
+
+    # band with a non-finite f0: nan
+    n_bad = np.where(n_points > 0, cum_bad[np.clip(i_hi + 1, 0, len(x))] - cum_bad[i_lo_c], 0)
+    mean_values = np.where(n_bad > 0, np.nan, mean_values)
+
+    band_info = pd.DataFrame({
+        'band': np.arange(1, len(center_wv) + 1),
+        'center_wv': wvv,
+        'bandwidth': bvv,
+        'wv_min': wv_min,
+        'wv_max': wv_max,
+        'mean_f0_trapz': mean_values,
+        'n_points': n_points
+    })
     
-    for i, (center_wv, bandwidth) in enumerate(zip(wvv, bvv)):
-        # Define band edges
-        wv_min = center_wv - bandwidth / 2
-        wv_max = center_wv + bandwidth / 2
-        
-        # Filter data within the band
-        mask = (df0['wv'] >= wv_min) & (df0['wv'] <= wv_max)
-        band_data = df0[mask].sort_values('wv')  # Sort by wavelength
-        
-        if len(band_data) > 1:
-            # Use trapezoidal integration
-            integrated_area = np.trapz(band_data['f0'], band_data['wv'])
-            actual_width = band_data['wv'].max() - band_data['wv'].min()
-            mean_f0 = integrated_area / actual_width if actual_width > 0 else band_data['f0'].mean()
-            n_points = len(band_data)
-            
-        elif len(band_data) == 1:
-            # Single point - use that value
-            mean_f0 = band_data['f0'].iloc[0]
-            n_points = 1
-            
-        else:
-            # No data in band
-            mean_f0 = np.nan
-            n_points = 0
-        
-        mean_values.append(mean_f0)
-        band_info.append({
-            'band': i+1,
-            'center_wv': center_wv,
-            'bandwidth': bandwidth,
-            'wv_min': wv_min,
-            'wv_max': wv_max,
-            'mean_f0_trapz': mean_f0,
-            'n_points': n_points
-        })
-    
-    return np.array(mean_values), pd.DataFrame(band_info)
\ No newline at end of file
+    return mean_values, band_info
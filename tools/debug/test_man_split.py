@@ -0,0 +1,78 @@
+"""
+split small MAN files with man_split_aeronet_data_folder and check the day folders and the site catalog
+against reading all the files (get_man_all)
+
+run with pytest, or as a script: python tools/debug/test_man_split.py
+"""
+import os
+import sys
+import tempfile
+
+import pandas as pd
+
+mapol_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.append(mapol_path)
+from tools.aeronet_batch_man import man_split_aeronet_data_folder
+from tools.aeronet_matchup_man import get_man_all, read_man_csv
+from tools.narwhal_site_catalog import get_site_catalog
+
+TSPAN = ('2024-06-01', '2024-06-02')
+
+def write_man_file(file1, rows):
+    """MAN file: 6 metadata lines, the header, then the rows (date, time, lat, lon)"""
+    with open(file1, 'w') as f:
+        for i in range(6):
+            f.write(f"metadata line {i}\n")
+        f.write("Date(dd:mm:yyyy),Time(hh:mm:ss),Day_of_Year,AOD_500nm,AOD_870nm,Latitude,Longitude\n")
+        for i, (date1, time1, lat, lon) in enumerate(rows):
+            f.write(f"{date1},{time1},153,{0.1 + i/100:.3f},-999.,{lat},{lon}\n")
+
+def get_input_folder(base_path):
+    input_folder = os.path.join(base_path, 'input')
+    os.makedirs(input_folder, exist_ok=True)
+    write_man_file(os.path.join(input_folder, 'Cruise_A_22_all_points.lev15'), \
+                   [('01:06:2024', '10:00:00', 10.1, 20.1), ('01:06:2024', '11:00:00', 10.2, 20.2), \
+                    ('02:06:2024', '09:00:00', 11.0, 21.0), ('02:06:2024', '09:00:00', 11.0, 21.0)])
+    write_man_file(os.path.join(input_folder, 'ShipB_23_all_points.lev15'), \
+                   [('01:06:2024', '12:00:00', -5.0, 100.0), ('02:06:2024', '13:00:00', -6.0, 101.0)])
+    return input_folder
+
+def check_catalog(suite_path, n_sites):
+    df_catalog = get_site_catalog(suite_path, TSPAN, flag_man=True).reset_index(drop=True)
+    df_all = get_man_all(suite_path, TSPAN, flag_man=True, flag_list=True).reset_index(drop=True)
+    assert len(df_catalog) == n_sites
+    pd.testing.assert_frame_equal(df_catalog, df_all, check_dtype=False)
+
+def test_man_split_csv(tmp_path):
+    input_folder = get_input_folder(str(tmp_path))
+    output_folder = os.path.join(str(tmp_path), 'MAN')
+    man_split_aeronet_data_folder(input_folder, output_folder)
+
+    assert sorted(os.listdir(os.path.join(output_folder, '20240601'))) == ['Cruise_A.csv', 'ShipB.csv']
+    assert os.path.exists(os.path.join(output_folder, 'site_catalog.sqlite'))
+    #the repeated row of Cruise_A is kept in the csv file
+    check_catalog(output_folder, 6)
+
+def test_man_split_store(tmp_path):
+    input_folder = get_input_folder(str(tmp_path))
+    store_path = os.path.join(str(tmp_path), 'store', 'MAN')
+    man_split_aeronet_data_folder(input_folder, os.path.join(str(tmp_path), 'MAN'), parquet_path=store_path)
+
+    #one file per day, read back as the csv files, the repeated row is dropped when written
+    assert os.listdir(os.path.join(store_path, '20240602')) == ['data.parquet']
+    df = read_man_csv(os.path.join(store_path, '20240602'))
+    assert sorted(df['Site_Name']) == ['Cruise_A_p0', 'ShipB_p0']
+    assert list(df.loc[df['Site_Name'] == 'ShipB_p0', 'Longitude(decimal_degrees)']) == [101.0]
+    check_catalog(store_path, 5)
+
+    #split again: the rows of the sites are replaced, not added
+    man_split_aeronet_data_folder(input_folder, os.path.join(str(tmp_path), 'MAN'), parquet_path=store_path)
+    assert len(read_man_csv(os.path.join(store_path, '20240601'))) == 3
+    check_catalog(store_path, 5)
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp_path:
+        test_man_split_csv(tmp_path)
+    with tempfile.TemporaryDirectory() as tmp_path:
+        test_man_split_store(tmp_path)
+    print("ok")
@@ -0,0 +1,65 @@
+"""
+check match_time_aeronet_sites against a direct window mean/std for each pace row
+
+run with pytest, or as a script: python tools/debug/test_match_time_aeronet.py
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+mapol_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.append(mapol_path)
+from tools.aeronet_matchup_match import match_time_aeronet, match_time_aeronet_sites
+
+def get_test_data():
+    """two sites, aeronet every 20 min with -999 values, pace at a few times"""
+    times = pd.date_range('2024-06-01 10:00', periods=12, freq='20min')
+    aeronet_df2 = pd.DataFrame({'site': ['A']*12 + ['B']*12,
+                                'datetime': list(times)*2,
+                                'aod_500': np.r_[np.linspace(0.1, 0.2, 12), np.linspace(0.3, 0.4, 12)],
+                                'aod_870': np.r_[[-999.0]*3, np.linspace(0.05, 0.1, 9), np.linspace(0.2, 0.3, 12)]})
+    pace_df = pd.DataFrame({'site': ['A', 'A', 'B', 'B'],
+                            'datetime': pd.to_datetime(['2024-06-01 10:05', '2024-06-01 12:30',
+                                                        '2024-06-01 11:00', '2024-06-01 20:00']),
+                            'rho_500': [0.1, 0.2, 0.3, 0.4]})
+    return pace_df, aeronet_df2
+
+def get_window_stats(aeronet_df2, site1, ts, delta_hour=1):
+    df = aeronet_df2.loc[(aeronet_df2['site'] == site1) & \
+                         ((aeronet_df2['datetime'] - ts).abs() <= pd.Timedelta(hours=delta_hour))]
+    df = df[['aod_500', 'aod_870']].replace(-999, np.nan)
+    return len(df), df.mean(), df.std()
+
+def test_match_time_aeronet_sites():
+    pace_df, aeronet_df2 = get_test_data()
+    aeronet_df2_in = aeronet_df2.copy()
+    mean_df, std_df, pace_mean, pace_std = match_time_aeronet_sites(pace_df, pace_df, aeronet_df2, ['A', 'B'])
+
+    #the input is not modified
+    pd.testing.assert_frame_equal(aeronet_df2, aeronet_df2_in)
+
+    #the pace row at 20:00 has no aeronet data in the window
+    assert len(mean_df) == 3
+    assert len(pace_mean) == 3
+    for _, row in mean_df.iterrows():
+        count, mean, std = get_window_stats(aeronet_df2, row['site'], row['datetime'])
+        assert row['count'] == count
+        np.testing.assert_allclose(row[['aod_500', 'aod_870']].to_numpy(dtype=float), mean.to_numpy())
+        row_std = std_df.loc[(std_df['site'] == row['site']) & (std_df['datetime'] == row['datetime'])].iloc[0]
+        np.testing.assert_allclose(row_std[['aod_500', 'aod_870']].to_numpy(dtype=float), std.to_numpy())
+
+def test_match_time_aeronet():
+    pace_df, aeronet_df2 = get_test_data()
+    mean_df, std_df, _, _ = match_time_aeronet(pace_df, pace_df, aeronet_df2, 'B')
+    assert list(mean_df['site']) == ['B']
+    count, mean, _ = get_window_stats(aeronet_df2, 'B', pd.Timestamp('2024-06-01 11:00'))
+    assert mean_df['count'].iloc[0] == count
+    np.testing.assert_allclose(mean_df[['aod_500', 'aod_870']].iloc[0].to_numpy(dtype=float), mean.to_numpy())
+
+if __name__ == '__main__':
+    print("pandas version:", pd.__version__)
+    test_match_time_aeronet_sites()
+    test_match_time_aeronet()
+    print("ok")
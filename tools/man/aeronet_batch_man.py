@@ -6,7 +6,9 @@ from tqdm import tqdm
 import glob
 import re
 from collections import defaultdict
-from tools.aeronet_batch_split import remove_duplicates_in_csv_files, header_aeronet_data
+from tools.narwhal_split_aeronet import remove_duplicates_in_csv_files, header_aeronet_data
+from tools.narwhal_parquet_store import write_store_day, read_store_day, DAY_FILE
+from tools.narwhal_site_catalog import update_site_catalog, init_site_day, add_site_rows, set_site_day
 
 import requests
 import tarfile
@@ -116,7 +118,8 @@ def man_split_aeronet_data_folder(input_folder, output_folder,
                               date_name="Date(dd:mm:yyyy)",
                               chunk_size=10**6,
                               overwrite=True,
-                              mode='a', site_pattern=r"^(.*?)_\d{2}"):
+                              mode='a', site_pattern=r"^(.*?)_\d{2}", parquet_path=None,
+                              update_catalog=True):
     """
     Processes all AERONET part files in input_folder.
     Merges all parts per site, splits daily, preserves all columns, and adds "AERONET_Site" as first column.
@@ -124,6 +127,11 @@ def man_split_aeronet_data_folder(input_folder, output_folder,
 
     Get site name based on: site_pattern r"^(.*?)_\d{2}" (string before the first _??)
 
+    parquet_path: write the parquet store <parquet_path>/<YYYYMMDD>/data.parquet instead of
+    the csv files (see narwhal_parquet_store), the rows of the sites are replaced in the day file
+
+    update_catalog: update the site catalog (narwhal_site_catalog) for the days written
+
     Notes:
     add with open(input_file, errors="replace") to avoid break the code, for the following example:
         UnicodeDecodeError on line 4: 'utf-8' codec can't decode byte 0xe9 in position 21: invalid continuation byte
@@ -157,6 +165,12 @@ def man_split_aeronet_data_folder(input_folder, output_folder,
         else:
             print(f"Skipped file with bad name: {base}")
 
+    # Sites of the rows written in each day, for the site catalog
+    site_rows = {}
+
+    # Rows of each day for the parquet store, written once per day after all the sites
+    store_days = defaultdict(list)
+
     # For each site, process all its part-files together
     for site, part_files in site_files.items():
         print(f"\nProcessing site '{site}' with {len(part_files)} file parts")
@@ -199,7 +213,13 @@ def man_split_aeronet_data_folder(input_folder, output_folder,
                 print(f"Invalid date '{date_val}' for site '{site}' - skipping.")
                 continue
 
+            if parquet_path is not None:
+                # parquet store instead of csv, written after all the sites
+                store_days[formatted_date].append(date_df)
+                continue
+
             date_folder = os.path.join(output_folder, formatted_date)
+            init_site_day(site_rows, formatted_date, date_folder)
             os.makedirs(date_folder, exist_ok=True)
 
             output_file = os.path.join(date_folder, f"{site}.csv")
@@ -214,4 +234,27 @@ def man_split_aeronet_data_folder(input_folder, output_folder,
             write_header = overwrite or not os.path.exists(output_file)
             date_df.to_csv(output_file, mode='w' if overwrite else 'a',
                            index=False, header=write_header)
-            print(f"  Wrote {len(date_df)} records to {output_file}")
\ No newline at end of file
+            add_site_rows(site_rows, formatted_date, date_folder, site, date_df, flag_man=True, add=False)
+            print(f"  Wrote {len(date_df)} records to {output_file}")
+
+    # parquet store: one file per day, the rows of the sites are replaced
+    for formatted_date, dfv in store_days.items():
+        day_folder = os.path.join(parquet_path, formatted_date)
+        day_df = pd.concat(dfv, ignore_index=True)
+        if not overwrite and os.path.exists(os.path.join(day_folder, DAY_FILE)):
+            site0v = set(read_store_day(day_folder, columns=["AERONET_Site"])["AERONET_Site"])
+            for site in sorted(site0v & set(day_df["AERONET_Site"])):
+                print(f"  (skipped existing {site} in {day_folder})")
+            day_df = day_df.loc[~day_df["AERONET_Site"].isin(site0v)]
+        if len(day_df) == 0:
+            continue
+        site1v = day_df["AERONET_Site"].unique()
+        store_df = write_store_day(day_df, day_folder, replace_sites=site1v)
+        set_site_day(site_rows, formatted_date, store_df, flag_man=True)
+        print(f"  Wrote {int(store_df['AERONET_Site'].isin(site1v).sum())} records to {os.path.join(day_folder, DAY_FILE)}")
+
+    if update_catalog and len(site_rows) > 0:
+        try:
+            update_site_catalog(parquet_path if parquet_path is not None else output_folder, site_rows, flag_man=True)
+        except Exception as e:
+            print(f"Error updating site catalog: {e}")
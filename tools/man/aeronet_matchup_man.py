@@ -9,7 +9,10 @@ import glob
 import os
 import glob
 import pandas as pd
+from collections import OrderedDict
 from IPython.display import display, HTML
+from tools.narwhal_parquet_store import is_store_day, read_store_day
+from tools.narwhal_day_folder import get_file_list, get_folder_mtime
 
 def format_man_df(df2, flag_man=True, flag_list=False):
     """
@@ -44,23 +47,6 @@ def format_man_df(df2, flag_man=True, flag_list=False):
     return df2
 
     
-def get_file_list(base_path, tspan):
-    """
-    get all file path
-    """
-
-    # Generate date strings
-    dates = pd.date_range(start=tspan[0], end=tspan[1], freq='D')
-    date_strs = [d.strftime('%Y%m%d') for d in dates]
-
-    pathv = []
-    for ds in date_strs:
-        dir_path = os.path.join(base_path, ds)
-        pathv.append(dir_path)
-    pathv.sort()
-    return pathv
-
-
 def get_man_all(man_path, tspan, flag_man=True, flag_list=False):
     """
     get all man data in the path and tspan
@@ -89,16 +75,66 @@ def get_man_all(man_path, tspan, flag_man=True, flag_list=False):
     
     return dfv2
 
+#parsed day folders: (folder1, flag_man, flag_list) -> (folder mtime, df, Site_Name index)
+MAN_DAY_CACHE = OrderedDict()
+MAN_DAY_CACHE_SIZE = 8
+
+def get_man_day(folder1, flag_man=True, flag_list=False):
+    """
+    parsed data of a day folder (read_man_csv) and the rows of each Site_Name,
+    kept in a small LRU cache (MAN_DAY_CACHE), read again if the folder mtime changed
+    (one stat per call, files added, removed or replaced, as by the split writers of the parquet store),
+    note a csv file appended in place does not change the folder mtime
+
+    return df, dict Site_Name -> row positions
+    """
+    key = (os.path.abspath(folder1), flag_man, flag_list)
+    stamp = get_folder_mtime(folder1)
+
+    if key in MAN_DAY_CACHE and MAN_DAY_CACHE[key][0] == stamp:
+        MAN_DAY_CACHE.move_to_end(key)
+        return MAN_DAY_CACHE[key][1], MAN_DAY_CACHE[key][2]
+
+    df = read_man_csv(folder1, flag_man=flag_man, flag_list=flag_list)
+    site_index = df.groupby('Site_Name', sort=False).indices if 'Site_Name' in df.columns else {}
+
+    MAN_DAY_CACHE[key] = (stamp, df, site_index)
+    MAN_DAY_CACHE.move_to_end(key)
+    while len(MAN_DAY_CACHE) > MAN_DAY_CACHE_SIZE:
+        MAN_DAY_CACHE.popitem(last=False)
+
+    return df, site_index
+
 def get_man_site(folder1, site1):
-    dfv2 = get_man_csv(folder1)
-    df2 = dfv2.loc[dfv2.Site_Name==site1]
+    """rows of site1 in the day folder, from the cached folder data"""
+    dfv2, site_index = get_man_day(folder1)
+    df2 = dfv2.iloc[site_index.get(site1, [])].copy()
     return df2
-    
+
 def get_man_csv(folder1, flag_man=True, flag_list=False):
+    """
+    combine all aeronet data together, and return df (a copy of the cached folder data, see get_man_day)
+    """
+    dfv2, _ = get_man_day(folder1, flag_man=flag_man, flag_list=flag_list)
+    return dfv2.copy()
+
+def read_man_csv(folder1, flag_man=True, flag_list=False):
     """
     combine all aeronet data together, and return df
     note that: some variables contains (int) some do not
+
+    a day folder of the parquet store is read at once, the row number of each site (for the MAN
+    Site_Name) is counted in the order the rows are written, as in the csv file of the site
     """
+    if is_store_day(folder1):
+        df2 = read_store_day(folder1)
+        if len(df2) == 0:
+            return pd.DataFrame()
+        df2.columns = df2.columns.str.replace(r'\(int\)', '', regex=True)
+        df2.index = df2.groupby('AERONET_Site', sort=False).cumcount().to_numpy()
+        df2 = format_man_df(df2, flag_man=flag_man, flag_list=flag_list)
+        return df2.reset_index(drop=True)
+
     filev2 = glob.glob(os.path.join(folder1, '*.csv'))
     dfv2 = []
     
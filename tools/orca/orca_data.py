@@ -8,7 +8,8 @@ import re
 import requests
 import subprocess
 import numpy as np
-import xarray as xr
+
+from tools.narwhal_granule import read_granule_vars
 
 def extract_timestamp(filename):
     """
@@ -37,19 +38,18 @@ def filter_data(file1, iwv550 = 1, aot_min = 0.15,  criteria = (30, 20, 2.0)):
 
     nv_ref_min, nv_dolp_min, chi2_max = criteria
     
-    datatree = xr.open_datatree(file1)
-    dataset = xr.merge(datatree.to_dict().values())
-    
+    #only read the variables used for filtering
+    dataset = read_granule_vars(file1, ["chi2", "aot", "nv_ref", "nv_dolp"])
 
-    chi2 = dataset["chi2"].values
-    aot = dataset["aot"].values
+    chi2 = dataset["chi2"]
+    aot = dataset["aot"]
     data = aot[:, :, iwv550]
     #total non-nan data
     npixel_valid0 = np.sum(~np.isnan(data))
 
     try:
-        nv_ref = dataset["nv_ref"].values
-        nv_dolp = dataset["nv_dolp"].values
+        nv_ref = dataset["nv_ref"]
+        nv_dolp = dataset["nv_dolp"]
         filter1 = (aot[:, :, iwv550] >= aot_min) & (nv_ref>=nv_ref_min) & (nv_dolp>=nv_dolp_min) & (chi2 <=chi2_max)
         print("use nv_ref, nv_dolp, chi2")
     except:
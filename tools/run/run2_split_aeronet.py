@@ -9,6 +9,8 @@ from tools.narwhal_split_aeronet import *
 
 path0='./aeronet_data_split/'
 overwrite=True
+#only split the data added since the last run of the same file (checkpoint in output_dir)
+incremental=False
 
 # Product name (suite1)
 #version1 = "v3"
@@ -66,10 +68,7 @@ split_aeronet_data(
     site_name=site_name,
     date_name=date_name,
     chunk_size=chunk_size,
-    overwrite=overwrite
-)
-
-remove_duplicates_in_csv_files(
-    output_dir=output_dir,
-    key_columns=[site_name, date_name, time_name]
+    overwrite=overwrite,
+    key_columns=[site_name, date_name, time_name],  # rows already split are not written again
+    incremental=incremental
 )
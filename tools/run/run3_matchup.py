@@ -23,7 +23,7 @@ sys.path.append(mapol_path)
 
 # Import your custom modules (preferably explicitly)
 from tools.narwhal_matchup import narwhal_matchup_daily
-from tools.narwhal_tools import print_threads_info, get_rules_str
+from tools.narwhal_tools import print_threads_info, get_rules_str, get_n_workers
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.max_rows', None)
@@ -86,6 +86,14 @@ def main():
     parser.add_argument("--no_cloud", action="store_true",
                        help="Do NOT use Earthdata cloud (default: use cloud)")
     parser.add_argument("--save_subset_loc_path", type=str, default=None, help="Default do not save subset, If path is given, save")
+    parser.add_argument("--match_mode", type=str, default='batch', \
+                        help="location search: batch (lon/lat kdtree), ecef (great circle radius), loop")
+    parser.add_argument("--n_workers", type=int, default=None, \
+                        help="number of processes for granule search/extraction (default: SLURM_CPUS_PER_TASK or 1)")
+    parser.add_argument("--interp_mode", type=str, default=None, \
+                        help="aod wavelength interpolation: angstrom (log-log), default use max_order")
+    parser.add_argument("--no_footprint", action="store_true",
+                       help="Do NOT use the granule footprint index to skip granules (default: use index)")
     
     
     args = parser.parse_args()
@@ -129,6 +137,16 @@ def main():
     if(save_subset_loc_path):
         os.makedirs(save_subset_loc_path, exist_ok=True)
 
+    #granule footprints are shared by all val_source and rules of the product
+    if(args.no_footprint):
+        footprint_db = None
+    else:
+        footprint_db = os.path.join(input_folder, product1, 'granule_footprint.sqlite')
+    print("granule footprint index:", footprint_db)
+
+    n_workers = args.n_workers if args.n_workers else get_n_workers()
+    print("number of workers for granules:", n_workers)
+
 
     ###########################
     print_threads_info()
@@ -164,7 +182,7 @@ def main():
     logo_path = os.path.join(mapol_path, "logo", 'narwhal_logo_v1.png')
     print("logo location:", logo_path)
     max_order=-1
-    print("interpolation order:", max_order)
+    print("interpolation order:", max_order, "mode:", args.interp_mode)
     narwhal_matchup_daily(matchup_save_folder, matchup_save_folder2, html_save_folder,\
                             val_url, val_path1, loc_suite1, tspan, \
                             product1, appkey, api_key, \
@@ -173,7 +191,8 @@ def main():
                             save_subset_loc_path, share_dir_base,\
                             val_source=val_source, flag_rm=flag_rm, \
                             flag_earthdata_cloud=flag_earthdata_cloud, df0=df0, \
-                            logo_path=logo_path, max_order=max_order)
+                            logo_path=logo_path, max_order=max_order, footprint_db=footprint_db, \
+                            match_mode=args.match_mode, n_workers=n_workers, interp_mode=args.interp_mode)
     
     t2=time.time()
     print("===total time for processing===", t2-t1)
@@ -0,0 +1,114 @@
+"""
+partitioned parquet store for the validation data, alternative to the csv tree
+
+    <store>/<suite>/<YYYYMMDD>/data.parquet   split_aeronet_data(..., parquet_path=<store>/<suite>)
+                                              man_split_aeronet_data_folder(..., parquet_path=<store>/<suite>)
+
+one file per day, the rows of a day are collected by the writers and added to the file at once,
+rows already in the file (same site, date and time) are not added again.
+
+rows are saved with -999 as nan, the site as a categorical column and the datetime already parsed
+from the date and time columns, the other columns are the same as in the csv files.
+
+A day folder with parquet files is read in place of the csv files by get_val_df, get_val_df_sites
+and get_man_csv (get_man_all), so the store is used by giving its path as val_path,
+the selection of the sites is pushed down to the parquet reader.
+
+pyarrow is only needed to write or read the store.
+"""
+import os
+import glob
+import importlib.util
+
+import numpy as np
+import pandas as pd
+
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+#file of a day folder of the store
+DAY_FILE = 'data.parquet'
+
+def check_pyarrow():
+    if not HAS_PYARROW:
+        raise ImportError("pyarrow is needed for the parquet store, install it or use the csv files")
+
+def format_store_df(df, site_name='AERONET_Site', date_name='Date(dd:mm:yyyy)', time_name='Time(hh:mm:ss)'):
+    """
+    prepare the rows to save in the store:
+    -999 to nan, numbers as float, text as str, site as categorical, add datetime
+
+    numbers read as text (e.g. in the chunk with the header line of the file) are converted,
+    so the columns have the same type in all the rows of a day
+    """
+    df = df.copy()
+    for col in df.columns:
+        if col in [site_name, date_name, time_name] or pd.api.types.is_numeric_dtype(df[col]):
+            continue
+        values = pd.to_numeric(df[col], errors='coerce')
+        if values.notna().any() and values.notna().sum() == df[col].notna().sum():
+            df[col] = values
+    df = df.replace(-999, np.nan)
+
+    for col in df.columns:
+        if pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = df[col].astype(float)
+        else:
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+
+    if date_name in df.columns and time_name in df.columns:
+        df['datetime'] = pd.to_datetime(df[date_name] + ' ' + df[time_name], \
+                                        format='%d:%m:%Y %H:%M:%S', errors='coerce')
+    df[site_name] = df[site_name].astype('category')
+
+    return df
+
+def write_store_day(df, day_folder, mode='a', replace_sites=None, site_name='AERONET_Site', \
+                    date_name='Date(dd:mm:yyyy)', time_name='Time(hh:mm:ss)'):
+    """
+    write the rows of one day into the file of day_folder (DAY_FILE)
+    mode='a': add to the rows in the file, mode='w': replace the file
+    replace_sites: the rows of these sites in the file are replaced by the new rows (mode='a')
+
+    rows with the same site, date and time are only kept once (the first one),
+    the file is written to a tmp file and then replaced, so it is not read half written
+
+    return the rows of the day file (as written)
+    """
+    check_pyarrow()
+    os.makedirs(day_folder, exist_ok=True)
+    output_file = os.path.join(day_folder, DAY_FILE)
+
+    df = format_store_df(df, site_name=site_name, date_name=date_name, time_name=time_name)
+    if mode == 'a' and os.path.exists(output_file):
+        df0 = pd.read_parquet(output_file)
+        if replace_sites is not None:
+            df0 = df0.loc[~df0[site_name].isin(list(replace_sites))]
+        df = pd.concat([df0.astype({site_name: object}), df.astype({site_name: object})], ignore_index=True)
+        df[site_name] = df[site_name].astype('category')
+
+    key_columns = [site_name, date_name, time_name]
+    if all(col in df.columns for col in key_columns):
+        df = df.drop_duplicates(subset=key_columns)
+
+    tmp_file = os.path.join(day_folder, '.' + DAY_FILE + '.tmp')
+    df.to_parquet(tmp_file, index=False)
+    os.replace(tmp_file, output_file)
+    return df
+
+def is_store_day(folder1):
+    """whether the day folder contains parquet files"""
+    return len(glob.glob(os.path.join(folder1, '*.parquet'))) > 0
+
+def read_store_day(folder1, sites=None, site_name='AERONET_Site', columns=None):
+    """
+    read all the rows of a day folder of the store (one read of the folder), in the order they are written
+    sites: only read these sites (filter in the parquet reader), None: all
+    """
+    check_pyarrow()
+    filters = [(site_name, 'in', list(sites))] if sites is not None else None
+    df = pd.read_parquet(folder1, columns=columns, filters=filters)
+    if len(df) == 0:
+        return pd.DataFrame()
+
+    df[site_name] = df[site_name].astype(object)
+    return df.reset_index(drop=True)
@@ -0,0 +1,275 @@
+"""
+site location catalog of the split validation data
+
+for each day folder of a suite (<suite>/<YYYYMMDD>/), the sites with their location and number of rows
+are saved in a sqlite file in the suite folder, so the locations for a tspan are one query
+instead of reading all the files of all the days (get_man_all with flag_list=True).
+
+    db_path = os.path.join(loc_search_path, 'site_catalog.sqlite')
+    aeronet_list_df1 = get_site_catalog(loc_search_path, tspan, flag_man=False)
+
+the split writers collect the sites of the rows they write (add_site_rows, set_site_day) and update the
+days they wrote (update_site_catalog) without reading the folders again, only a day that was not up to
+date in the catalog before the writes is read from its folder.
+the query only reads the catalog, days not in the catalog, or changed since (folder mtime, file names,
+sizes and mtimes), are read from the folders.
+
+flag_man=True: every row is a site (MAN), flag_man=False: one location per site (AERONET), same as get_man_all
+
+the folders are read with read_man_csv (aeronet_matchup_man, not the cache of get_man_csv, which only checks
+the folder mtime), imported only when needed, so the split writers do not load the matchup modules
+"""
+import os
+import json
+import sqlite3
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from tools.narwhal_day_folder import get_folder_stamp, get_file_list
+from tools.narwhal_parquet_store import is_store_day, read_store_day
+
+#location columns of the rows (lon, lat), same as format_man_df
+LOC_COLUMNS = {True: ('Longitude', 'Latitude'), False: ('Site_Longitude(Degrees)', 'Site_Latitude(Degrees)')}
+
+def open_site_catalog(db_path):
+    """open (create) the site catalog"""
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.execute("""CREATE TABLE IF NOT EXISTS site_day (
+                        date TEXT,
+                        flag_man INTEGER,
+                        site TEXT,
+                        lon REAL,
+                        lat REAL,
+                        n_rows INTEGER,
+                        aeronet_site TEXT,
+                        PRIMARY KEY (date, flag_man, site))""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS catalog_day (
+                        date TEXT,
+                        flag_man INTEGER,
+                        stamp TEXT,
+                        PRIMARY KEY (date, flag_man))""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_site_day_site ON site_day (site)")
+    conn.commit()
+    return conn
+
+def get_stamp_str(folder1):
+    """hash of the folder stamp (get_folder_stamp), None if the folder does not exist"""
+    stamp = get_folder_stamp(folder1)
+    if stamp is None:
+        return None
+    return hashlib.md5(json.dumps(stamp).encode()).hexdigest()
+
+def count_day_rows(folder1):
+    """number of rows of each AERONET_Site in the day folder (csv file of the site or parquet store)"""
+    if is_store_day(folder1):
+        df = read_store_day(folder1, columns=['AERONET_Site', 'Date(dd:mm:yyyy)', 'Time(hh:mm:ss)'])
+        if len(df) == 0:
+            return {}
+        return df.groupby('AERONET_Site').size().to_dict()
+
+    countv = {}
+    for name in os.listdir(folder1):
+        if name.endswith('.csv'):
+            with open(os.path.join(folder1, name), 'rb') as f:
+                countv[name[:-4]] = max(sum(1 for _ in f) - 1, 0)
+    return countv
+
+def catalog_site_day(conn, folder1, date1, flag_man=True, stamp=None):
+    """read the sites of one day folder and replace the entries of this day in the catalog"""
+    from tools.aeronet_matchup_man import read_man_csv
+
+    if stamp is None:
+        stamp = get_stamp_str(folder1)
+
+    df = read_man_csv(folder1, flag_man=flag_man, flag_list=True)
+    if len(df) > 0:
+        site_namev = df['Site_Name'].astype(str)
+        if flag_man:
+            n_rows = [1]*len(df)
+            aeronet_site = site_namev.str.replace(r'_p\d+$', '', regex=True)
+        else:
+            countv = count_day_rows(folder1)
+            n_rows = [countv.get(site1) for site1 in df['Site_Name']]
+            aeronet_site = site_namev
+        rows = list(zip([date1]*len(df), [int(flag_man)]*len(df), site_namev, \
+                        df['Longitude(decimal_degrees)'].astype(float), df['Latitude(decimal_degrees)'].astype(float), \
+                        n_rows, aeronet_site))
+    else:
+        rows = []
+
+    conn.execute("DELETE FROM site_day WHERE date=? AND flag_man=?", (date1, int(flag_man)))
+    conn.executemany("INSERT OR REPLACE INTO site_day VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.execute("INSERT OR REPLACE INTO catalog_day VALUES (?, ?, ?)", (date1, int(flag_man), stamp))
+    conn.commit()
+    return len(rows)
+
+def init_site_day(site_rows, date1, folder1):
+    """
+    entry of a day in site_rows (date -> entry), started before the first write into the day folder,
+    stamp0: stamp of the folder before the writes
+    """
+    if date1 not in site_rows:
+        site_rows[date1] = {'stamp0': get_stamp_str(folder1), 'full': False, 'sites': {}}
+    return site_rows[date1]
+
+def add_site_rows(site_rows, date1, folder1, site1, df, flag_man=False, add=True):
+    """
+    collect the rows df of site1 written into the day folder, for update_site_catalog
+    add=True: the rows are added to the rows of the site, add=False: the rows of the site are replaced
+    (add is set by the first write of the site in this run)
+
+    flag_man=False: location of the first row and number of rows, flag_man=True: location of each row
+    """
+    day = init_site_day(site_rows, date1, folder1)
+    site1 = str(site1)
+    if site1 not in day['sites']:
+        day['sites'][site1] = {'add': add, 'lon': [], 'lat': [], 'n_rows': 0}
+    entry = day['sites'][site1]
+
+    if flag_man or entry['n_rows'] == 0:
+        n_loc = len(df) if flag_man else min(len(df), 1)
+        for col, locv in zip(LOC_COLUMNS[flag_man], (entry['lon'], entry['lat'])):
+            if col in df.columns:
+                locv.extend(df[col].iloc[:n_loc].to_numpy(dtype=float).tolist())
+            else:
+                locv.extend([np.nan]*n_loc)
+    entry['n_rows'] += len(df)
+
+def set_site_day(site_rows, date1, df, site_name='AERONET_Site', flag_man=False):
+    """collect all the rows of a day (e.g. the day file of the parquet store), the entries of the day are replaced"""
+    site_rows[date1] = {'stamp0': None, 'full': True, 'sites': {}}
+    if len(df) == 0:
+        return
+    for site1, group in df.groupby(df[site_name].astype(str), sort=False):
+        add_site_rows(site_rows, date1, None, site1, group, flag_man=flag_man, add=False)
+
+def upsert_site_day(conn, date1, day, flag_man=True, stamp=None):
+    """
+    update the entries of one day with the rows collected by a writer (day: entry of init_site_day)
+
+    return False, without any change, if the day was not up to date in the catalog before the writes
+    (then the day is read from its folder)
+    """
+    flag = int(flag_man)
+    if day['full'] or day['stamp0'] is None:
+        #all the rows of the day are known, or the folder did not exist before the writes
+        conn.execute("DELETE FROM site_day WHERE date=? AND flag_man=?", (date1, flag))
+    else:
+        row = conn.execute("SELECT stamp FROM catalog_day WHERE date=? AND flag_man=?", (date1, flag)).fetchone()
+        if row is None or row[0] != day['stamp0']:
+            return False
+
+    for site1, entry in day['sites'].items():
+        if flag_man:
+            #every row is a site: <site>_p<row number in the site>
+            if entry['add']:
+                offset = conn.execute("SELECT COUNT(*) FROM site_day WHERE date=? AND flag_man=? AND aeronet_site=?", \
+                                      (date1, flag, site1)).fetchone()[0]
+            else:
+                conn.execute("DELETE FROM site_day WHERE date=? AND flag_man=? AND aeronet_site=?", (date1, flag, site1))
+                offset = 0
+            rows = [(date1, flag, f"{site1}_p{offset + i1}", lon, lat, 1, site1) \
+                    for i1, (lon, lat) in enumerate(zip(entry['lon'], entry['lat']))]
+        else:
+            #one location per site (first row), the number of rows is added
+            updated = 0
+            if entry['add']:
+                updated = conn.execute("UPDATE site_day SET n_rows=n_rows+? WHERE date=? AND flag_man=? AND site=?", \
+                                       (entry['n_rows'], date1, flag, site1)).rowcount
+            rows = [] if updated > 0 else [(date1, flag, site1, entry['lon'][0], entry['lat'][0], entry['n_rows'], site1)]
+        conn.executemany("INSERT OR REPLACE INTO site_day VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    conn.execute("INSERT OR REPLACE INTO catalog_day VALUES (?, ?, ?)", (date1, flag, stamp))
+    conn.commit()
+    return True
+
+def update_site_catalog(suite_path, site_rows, flag_man=True, db_path=None):
+    """
+    update the catalog for the days written into suite_path, used by the split writers
+    site_rows: rows collected while writing (add_site_rows, set_site_day), date YYYYMMDD -> entry,
+               or a list of days YYYYMMDD to read from the folders
+    """
+    if db_path is None:
+        db_path = os.path.join(suite_path, 'site_catalog.sqlite')
+    if not isinstance(site_rows, dict):
+        site_rows = {date1: None for date1 in site_rows}
+
+    conn = open_site_catalog(db_path)
+    n_read = 0
+    try:
+        for date1 in sorted(site_rows):
+            folder1 = os.path.join(suite_path, date1)
+            day = site_rows[date1]
+            if day is not None and not day['full'] and len(day['sites']) == 0:
+                #nothing written into this day (e.g. skipped folder)
+                continue
+            try:
+                if day is not None and upsert_site_day(conn, date1, day, flag_man=flag_man, \
+                                                       stamp=get_stamp_str(folder1)):
+                    continue
+                if os.path.isdir(folder1):
+                    catalog_site_day(conn, folder1, date1, flag_man=flag_man)
+                    n_read += 1
+            except Exception as e:
+                conn.rollback()
+                print(f"  Error updating site catalog {folder1}: {str(e)}")
+    finally:
+        conn.close()
+    print(f"site catalog updated for {len(site_rows)} days ({n_read} read from the folders): {db_path}")
+
+def get_site_catalog(loc_search_path, tspan, flag_man=True, db_path=None):
+    """
+    site names and locations in the days of tspan, same as get_man_all(..., flag_list=True)
+    the catalog is only read (opened read only), days not in the catalog or changed since
+    are read from the folders (read_man_csv), the catalog is updated by the split writers
+
+    return df: Site_Name, Longitude(decimal_degrees), Latitude(decimal_degrees)
+    """
+    from tools.aeronet_matchup_man import read_man_csv
+
+    if db_path is None:
+        db_path = os.path.join(loc_search_path, 'site_catalog.sqlite')
+
+    columns = ['Site_Name', 'Longitude(decimal_degrees)', 'Latitude(decimal_degrees)']
+    folder1v = get_file_list(loc_search_path, tspan)
+    date1v = [os.path.basename(folder1) for folder1 in folder1v]
+
+    stampv = {}
+    df_catalog = pd.DataFrame(columns=['date'] + columns)
+    if os.path.exists(db_path) and date1v:
+        conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, timeout=60)
+        try:
+            params = (int(flag_man), min(date1v), max(date1v))
+            stampv = dict(conn.execute("""SELECT date, stamp FROM catalog_day
+                                          WHERE flag_man=? AND date>=? AND date<=?""", params).fetchall())
+            df_catalog = pd.read_sql_query("""SELECT date, site, lon, lat FROM site_day
+                                              WHERE flag_man=? AND date>=? AND date<=?
+                                              ORDER BY date""", conn, params=params)
+        finally:
+            conn.close()
+        df_catalog = df_catalog.rename(columns={'site': 'Site_Name', 'lon': 'Longitude(decimal_degrees)', \
+                                                'lat': 'Latitude(decimal_degrees)'})
+
+    dfv = []
+    for folder1, date1 in zip(folder1v, date1v):
+        stamp = get_stamp_str(folder1)
+        if stamp is None:
+            #no folder for this day
+            continue
+        if stampv.get(date1) == stamp:
+            df1 = df_catalog.loc[df_catalog['date'] == date1, columns]
+        else:
+            print("not in site catalog, read:", folder1)
+            df1 = read_man_csv(folder1, flag_man=flag_man, flag_list=True)
+            df1 = df1[columns] if len(df1) > 0 else pd.DataFrame()
+        if len(df1) > 0:
+            dfv.append(df1)
+
+    if len(dfv) == 0:
+        return pd.DataFrame()
+
+    df = pd.concat(dfv, ignore_index=True)
+    return df.sort_values('Site_Name')
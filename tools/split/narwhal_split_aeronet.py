@@ -1,10 +1,15 @@
 import os
 import re
-from datetime import datetime
+import io
+import json
+import hashlib
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 from netCDF4 import Dataset
 from tqdm import tqdm  # For progress bar
+from tools.narwhal_parquet_store import write_store_day
+from tools.narwhal_site_catalog import update_site_catalog, init_site_day, add_site_rows, set_site_day
 
 def header_aeronet_data(file_path, start_str="AERONET_Site"):
     # Find the header line that starts with "AERONET_Site"
@@ -60,9 +65,208 @@ def make_column_names_unique(column_names):
     
     return unique_columns
     
+def get_row_keys(df, key_columns):
+    """keys of the rows (e.g. site, date, time) as strings, used for de-duplication"""
+    return df[key_columns].astype(str).agg(','.join, axis=1).to_numpy()
+
+def load_split_keys(output_file, key_columns):
+    """
+    load the keys of the rows already in output_file, from the key file output_file+'.keys'
+    if the key file is missing or older than output_file, the keys are read from output_file
+
+    return dict: keys (set), new (keys to add to the key file), rewrite (write the whole key file)
+    """
+    key_file = output_file + '.keys'
+    if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
+        return {'keys': set(), 'new': [], 'rewrite': True}
+
+    if os.path.exists(key_file) and os.path.getmtime(key_file) >= os.path.getmtime(output_file):
+        with open(key_file, 'r') as f:
+            keys = set(line.rstrip('\n') for line in f)
+        return {'keys': keys, 'new': [], 'rewrite': False}
+
+    try:
+        df = pd.read_csv(output_file, usecols=key_columns, dtype=str)
+        keys = set(get_row_keys(df, key_columns))
+    except Exception as e:
+        print(f"Error reading keys from {output_file}: {e}")
+        keys = set()
+    return {'keys': keys, 'new': [], 'rewrite': True}
+
+def save_split_keys(output_file, entry):
+    """write the new keys of output_file into output_file+'.keys'"""
+    if entry['rewrite']:
+        with open(output_file + '.keys', 'w') as f:
+            f.writelines(key + '\n' for key in entry['keys'])
+    elif len(entry['new']) > 0:
+        with open(output_file + '.keys', 'a') as f:
+            f.writelines(key + '\n' for key in entry['new'])
+    entry['new'] = []
+    entry['rewrite'] = False
+
+def open_split_file(handles, output_file, max_open_files=128, mode='a', opened=None, split_keys=None):
+    """
+    get the file handle of output_file from handles (an OrderedDict used as LRU cache),
+    open it if needed, and close the least recently used file if more than max_open_files are open
+
+    opened: set of files opened before in this run, the first open uses mode, later ones append
+    split_keys: keys of the open files (load_split_keys), saved and removed with the closed file
+    """
+    if output_file in handles:
+        handles.move_to_end(output_file)
+        return handles[output_file]
+
+    if len(handles) >= max_open_files:
+        file_old, handle_old = handles.popitem(last=False)
+        handle_old.close()
+        if split_keys is not None and file_old in split_keys:
+            save_split_keys(file_old, split_keys.pop(file_old))
+
+    if opened is not None and output_file in opened:
+        mode = 'a'
+    handle = open(output_file, mode, newline='')
+    handles[output_file] = handle
+    if opened is not None:
+        opened.add(output_file)
+    return handle
+
+def get_line_offset(input_file, skiprows):
+    """byte offset after the first skiprows lines of input_file"""
+    offset = 0
+    with open(input_file, 'rb') as f:
+        for _ in range(skiprows):
+            line = f.readline()
+            if not line:
+                break
+            offset += len(line)
+    return offset
+
+def get_complete_end(input_file, block_size=2**16):
+    """byte offset after the last complete line (a line still being written is not used)"""
+    size = os.path.getsize(input_file)
+    with open(input_file, 'rb') as f:
+        pos = size
+        while pos > 0:
+            start = max(0, pos - block_size)
+            f.seek(start)
+            block = f.read(pos - start)
+            idx = block.rfind(b'\n')
+            if idx >= 0:
+                return start + idx + 1
+            pos = start
+    return 0
+
+def get_tail_hash(input_file, offset, nbytes=256):
+    """hash of the bytes before offset, to check the part already split did not change"""
+    with open(input_file, 'rb') as f:
+        f.seek(max(0, offset - nbytes))
+        return hashlib.md5(f.read(min(offset, nbytes))).hexdigest()
+
+def load_split_checkpoint(checkpoint_file):
+    """checkpoint of the incremental split: input file -> offset, header hash, tail hash, size"""
+    if checkpoint_file is None or not os.path.exists(checkpoint_file):
+        return {}
+    try:
+        with open(checkpoint_file, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error reading checkpoint {checkpoint_file}: {e}")
+        return {}
+
+def save_split_checkpoint(checkpoint_file, checkpoint):
+    """write the checkpoint (to a tmp file first, so it is not left half written)"""
+    tmp_file = checkpoint_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(checkpoint, f, indent=1)
+    os.replace(tmp_file, checkpoint_file)
+
+def get_split_start(input_file, checkpoint, data_offset, header_hash):
+    """
+    byte offset to start the split of input_file: the offset in the checkpoint if the header and
+    the data already split are the same, otherwise the start of the data (data_offset)
+    """
+    entry = checkpoint.get(os.path.abspath(input_file))
+    if entry is None:
+        print("No checkpoint, split from the start of data")
+        return data_offset
+
+    offset = entry['offset']
+    if entry['header_hash'] != header_hash:
+        print("Header changed, split from the start of data")
+        return data_offset
+    if os.path.getsize(input_file) < offset or get_tail_hash(input_file, offset) != entry['tail_hash']:
+        print("File changed before the checkpoint, split from the start of data")
+        return data_offset
+
+    print(f"Continue from checkpoint, byte offset: {offset}")
+    return offset
+
+def read_csv_blocks(input_file, start, end, column_names, chunk_size, block_size=2**26):
+    """
+    read the lines of input_file between byte offsets start and end, as dataframes of chunk_size rows,
+    the file is read in blocks of block_size bytes cut at the line end
+    """
+    with open(input_file, 'rb') as f, tqdm(total=end - start, unit='B', unit_scale=True) as pbar:
+        f.seek(start)
+        pos = start
+        rest = b''
+        while pos < end:
+            data = f.read(min(block_size, end - pos))
+            if not data:
+                break
+            pos += len(data)
+            pbar.update(len(data))
+
+            data = rest + data
+            idx = data.rfind(b'\n') + 1 if pos < end else len(data)
+            block, rest = data[:idx], data[idx:]
+            if len(block) == 0:
+                continue
+
+            for chunk in pd.read_csv(io.BytesIO(block), names=column_names, header=None, chunksize=chunk_size):
+                yield chunk
+
+def check_date_folder(date_folder, overwrite, created_folders, skipped_folders):
+    """
+    whether to write into date_folder: always if created in this run,
+    if it exists before this run and not overwriting, skip it (added to skipped_folders)
+    """
+    if date_folder in created_folders:
+        return True
+
+    if not overwrite and (date_folder in skipped_folders or os.path.exists(date_folder)):
+        if date_folder not in skipped_folders:
+            print(f"Skipping full folder: {date_folder}")
+            skipped_folders.add(date_folder)
+        return False
+
+    # Create the folder for the first time and mark it as created
+    os.makedirs(date_folder, exist_ok=True)
+    created_folders.add(date_folder)
+    return True
+
+def write_store_days(store_days, written, mode='a', site_name="AERONET_Site", \
+                     date_name="Date(dd:mm:yyyy)", time_name="Time(hh:mm:ss)", site_rows=None, catalog_flag_man=False):
+    """
+    write the rows collected for each day folder (store_days: folder -> list of df) to the parquet store,
+    one file per day, mode='w': the file is replaced the first time it is written in this run (written)
+    site_rows: collect the sites of the day files written, for the site catalog (set_site_day)
+    """
+    for date_folder, dfv in store_days.items():
+        day_mode = 'a' if (mode == 'a' or date_folder in written) else 'w'
+        day_df = write_store_day(pd.concat(dfv, ignore_index=True), date_folder, mode=day_mode, \
+                                 site_name=site_name, date_name=date_name, time_name=time_name)
+        written.add(date_folder)
+        if site_rows is not None:
+            set_site_day(site_rows, os.path.basename(date_folder), day_df, site_name=site_name, \
+                         flag_man=catalog_flag_man)
+    store_days.clear()
+
 def split_aeronet_data(input_file, output_dir, column_names, skiprows=6, 
                        site_name="AERONET_Site", date_name="Date(dd:mm:yyyy)", 
-                       chunk_size=10**6, overwrite=True, mode='a'):
+                       chunk_size=10**6, overwrite=True, mode='a', max_open_files=128, key_columns=None, \
+                       incremental=False, checkpoint_file=None, parquet_path=None, time_name="Time(hh:mm:ss)", \
+                       update_catalog=True, catalog_flag_man=False, store_rows=10**7):
     """
     Splits a large AERONET data file into smaller CSV files based on site and day.
     Optionally overwrites or skips existing folders.
@@ -75,69 +279,164 @@ def split_aeronet_data(input_file, output_dir, column_names, skiprows=6,
     - date_name: Column name referring to the measurement date (in 'dd:mm:yyyy').
     - chunk_size: Number of rows to process at a time (for large files).
     - overwrite: If True, overwrites existing folders for a day; if False, skips those folders.
-    - mode='a': append to existing file, since the file is written line by line
+    - mode='a': append to existing file, mode='w': the file is rewritten when first opened in this run
+    - max_open_files: number of output files kept open (least recently used are closed)
+    - key_columns: columns to identify duplicates (e.g. site, date, time), rows already in the
+      output file are not written again, the keys are kept in <site>.csv.keys next to each file.
+      None: no check, duplicates need clean up (remove_duplicates_in_csv_files) if the file is split again
     
-    Note that, there could be an element of data belong to the next day but at 00:00:00, set overwrite=True
+    - incremental: only split the data added after the last split of the same input file,
+      the byte offset reached is saved in checkpoint_file (default: output_dir/.split_checkpoint.json)
+      together with a hash of the header and of the data before the offset, if they changed the file
+      is split from the start. Use with key_columns, in case the same rows are split again.
+      Existing day folders are appended to (overwrite=False is not used), the rows skipped would be lost.
+    - parquet_path: write the parquet store <parquet_path>/<YYYYMMDD>/data.parquet instead of the csv files
+      (see narwhal_parquet_store), one file per day, rows already in the file are not added again
+    - store_rows: rows collected before the days are written to the parquet store
+    - time_name: column of the measurement time, used for the datetime in the parquet store
+    - update_catalog: update the site catalog (narwhal_site_catalog) for the days written, with the sites
+      of the rows written (the folders are not read again),
+      catalog_flag_man: catalog every row as a site (MAN) or one location per site (AERONET)
     
-    there also could be duplicated elements, need clean up if the file is opened several times
+    Each chunk is grouped by (date, site) and each group is written with one append,
+    the header is written when the file is empty.
+
+    Note that, there could be an element of data belong to the next day but at 00:00:00, set overwrite=True
     """
     # Ensure the output directory exists
     os.makedirs(output_dir, exist_ok=True)
 
-    # Estimate total chunks
-    total_rows = sum(1 for _ in open(input_file)) - skiprows  # Total rows excluding metadata lines
-    total_chunks = total_rows // chunk_size + (1 if total_rows % chunk_size > 0 else 0)
-    print("Total rows:", total_rows, "Total chunks:", total_chunks)
+    # Byte range to split: after the AERONET metadata lines (or the checkpoint), to the end of the file,
+    # incremental: to the last complete line, a line still being written is split next time
+    data_offset = get_line_offset(input_file, skiprows)
+    end = get_complete_end(input_file) if incremental else os.path.getsize(input_file)
+    header_hash = hashlib.md5(','.join(column_names).encode()).hexdigest()
+
+    if checkpoint_file is None:
+        checkpoint_file = os.path.join(output_dir, '.split_checkpoint.json')
+    checkpoint = load_split_checkpoint(checkpoint_file) if incremental else {}
+    start = get_split_start(input_file, checkpoint, data_offset, header_hash) if incremental else data_offset
+    print("Bytes to split:", max(end - start, 0))
+
+    # The checkpoint moves past all the rows read, so existing day folders are appended to (not skipped)
+    if incremental and not overwrite:
+        print("Incremental split: existing folders are appended to, overwrite=False is not used")
+        overwrite = True
 
     # Track created folders and skipped folders
     created_folders = set()
     skipped_folders = set()
+
+    handles = OrderedDict()
+    opened = set()
+    split_keys = {}
+    n_duplicates = 0
+    store_days = {}
+    store_written = set()
+    n_store_rows = 0
+    site_rows = {} if update_catalog else None
     
-    # Read data in chunks
-    for chunk in tqdm(pd.read_csv(input_file, names=column_names, 
-                                  skiprows=skiprows,  # Skip the AERONET metadata lines
-                                  chunksize=chunk_size), total=total_chunks):
-        
-        # Process each row in the chunk
-        for _, row in chunk.iterrows():
-            site = row[site_name]  # Get the site name
-            date = row[date_name]  # Get the measurement date
-
-            #print(site_name, date_name)
-            #print(row)
-            
-            # Convert date to YYYYMMDD format
-            try:
-                #print("date:", date)
-                formatted_date = datetime.strptime(date, "%d:%m:%Y").strftime("%Y%m%d")
-            except ValueError:
-                # Skip rows with invalid date formats
-                print(f"Skipping invalid date: {date}")
+    try:
+        # Read data in chunks
+        for chunk in read_csv_blocks(input_file, start, end, column_names, chunk_size):
+
+            # Convert date to YYYYMMDD format, skip rows with invalid date formats
+            dates = pd.to_datetime(chunk[date_name], format="%d:%m:%Y", errors='coerce')
+            invalid = dates.isna()
+            if invalid.any():
+                for date in chunk.loc[invalid, date_name].unique():
+                    print(f"Skipping invalid date: {date}")
+                chunk = chunk.loc[~invalid]
+                dates = dates.loc[~invalid]
+            formatted_dates = dates.dt.strftime("%Y%m%d")
+
+            if parquet_path is not None:
+                # Collect the rows of each day, written to the day file of the parquet store
+                for formatted_date, group in chunk.groupby(formatted_dates, sort=False):
+                    date_folder = os.path.join(parquet_path, formatted_date)
+                    if check_date_folder(date_folder, overwrite, created_folders, skipped_folders):
+                        store_days.setdefault(date_folder, []).append(group)
+                        n_store_rows += len(group)
+                if n_store_rows >= store_rows:
+                    write_store_days(store_days, store_written, mode=mode, site_name=site_name, \
+                                     date_name=date_name, time_name=time_name, \
+                                     site_rows=site_rows, catalog_flag_man=catalog_flag_man)
+                    n_store_rows = 0
                 continue
-            
-            # Create directory structure and filename
-            date_folder = os.path.join(output_dir, formatted_date)  # YYYYMMDD folder
-
-            # Check whether to handle the folder based on the `overwrite` parameter
-            if not overwrite:
-                # Skip folder if it exists and not overwriting
-                if date_folder in skipped_folders or os.path.exists(date_folder):
-                    if date_folder not in skipped_folders:
-                        print(f"Skipping full folder: {date_folder}")
-                        skipped_folders.add(date_folder)
+
+            for (formatted_date, site), group in chunk.groupby([formatted_dates, chunk[site_name]], sort=False):
+                # Create directory structure and filename
+                date_folder = os.path.join(output_dir, formatted_date)  # YYYYMMDD folder
+
+                # Folder stamp before the first write of this run, for the site catalog
+                if site_rows is not None and date_folder not in created_folders:
+                    init_site_day(site_rows, formatted_date, date_folder)
+
+                # Skip folder if it exists before this run and not overwriting
+                if not check_date_folder(date_folder, overwrite, created_folders, skipped_folders):
                     continue
-            
-            # Create the folder for the first time and mark it as created
-            if date_folder not in created_folders:
-                os.makedirs(date_folder, exist_ok=True)
-                created_folders.add(date_folder)
-            
-            # Final output file
-            output_file = os.path.join(date_folder, f"{site}.csv")
-            
-            # Write or append the row to its corresponding file
-            row.to_frame().T.to_csv(output_file, mode=mode, index=False, 
-                                    header=not os.path.exists(output_file))  # Add header if file doesn't exist
+
+                # Final output file
+                output_file = os.path.join(date_folder, f"{site}.csv")
+
+                # Drop the rows already in the file (or earlier in the group)
+                if key_columns is not None:
+                    if output_file not in split_keys:
+                        if output_file not in opened and mode == 'w':
+                            split_keys[output_file] = {'keys': set(), 'new': [], 'rewrite': True}
+                        else:
+                            split_keys[output_file] = load_split_keys(output_file, key_columns)
+                    entry = split_keys[output_file]
+
+                    row_keys = get_row_keys(group, key_columns)
+                    is_new = ~pd.Series(row_keys).duplicated().to_numpy()
+                    is_new &= np.array([key not in entry['keys'] for key in row_keys], dtype=bool)
+                    n_duplicates += len(group) - int(is_new.sum())
+                    if not is_new.any():
+                        if output_file not in handles:
+                            save_split_keys(output_file, split_keys.pop(output_file))
+                        continue
+                    group = group.loc[is_new]
+                    new_keys = row_keys[is_new]
+                    entry['keys'].update(new_keys)
+                    entry['new'].extend(new_keys)
+
+                # Append all the rows of the site and day, add header if the file is empty
+                add = not (mode == 'w' and output_file not in opened)
+                handle = open_split_file(handles, output_file, max_open_files=max_open_files, \
+                                         mode=mode, opened=opened, split_keys=split_keys)
+                group.to_csv(handle, index=False, header=(handle.tell() == 0))
+                if site_rows is not None:
+                    add_site_rows(site_rows, formatted_date, date_folder, site, group, \
+                                  flag_man=catalog_flag_man, add=add)
+
+        if len(store_days) > 0:
+            write_store_days(store_days, store_written, mode=mode, site_name=site_name, \
+                             date_name=date_name, time_name=time_name, \
+                             site_rows=site_rows, catalog_flag_man=catalog_flag_man)
+    finally:
+        for output_file, handle in handles.items():
+            handle.close()
+            if output_file in split_keys:
+                save_split_keys(output_file, split_keys.pop(output_file))
+
+    if key_columns is not None:
+        print(f"Skipped {n_duplicates} duplicated rows.")
+
+    if update_catalog and len(site_rows) > 0:
+        try:
+            update_site_catalog(parquet_path if parquet_path is not None else output_dir, \
+                                site_rows, flag_man=catalog_flag_man)
+        except Exception as e:
+            print(f"Error updating site catalog: {e}")
+
+    if incremental:
+        checkpoint = load_split_checkpoint(checkpoint_file)
+        checkpoint[os.path.abspath(input_file)] = {'offset': max(end, start), 'header_hash': header_hash, \
+                                                   'tail_hash': get_tail_hash(input_file, max(end, start)), \
+                                                   'size': os.path.getsize(input_file)}
+        save_split_checkpoint(checkpoint_file, checkpoint)
+        print("Checkpoint saved:", checkpoint_file)
     
     # Print summary of skipped folders
     if not overwrite:
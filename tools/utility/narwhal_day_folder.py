@@ -0,0 +1,45 @@
+"""
+day folders of the split validation data (<suite>/<YYYYMMDD>/)
+
+only light imports, used by the split writers and the site catalog as well as the matchup
+"""
+import os
+
+import pandas as pd
+
+def get_file_list(base_path, tspan):
+    """
+    get all file path
+    """
+
+    # Generate date strings
+    dates = pd.date_range(start=tspan[0], end=tspan[1], freq='D')
+    date_strs = [d.strftime('%Y%m%d') for d in dates]
+
+    pathv = []
+    for ds in date_strs:
+        dir_path = os.path.join(base_path, ds)
+        pathv.append(dir_path)
+    pathv.sort()
+    return pathv
+
+def get_folder_mtime(folder1):
+    """mtime of the folder (ns), changed when files are added, removed or replaced, None if it does not exist"""
+    try:
+        return os.stat(folder1).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def get_folder_stamp(folder1):
+    """folder mtime and (name, size, mtime) of the data files, to check whether the folder changed"""
+    try:
+        folder_mtime = os.stat(folder1).st_mtime_ns
+        files = []
+        with os.scandir(folder1) as it:
+            for entry in it:
+                if entry.name.endswith('.csv') or entry.name.endswith('.parquet'):
+                    st = entry.stat()
+                    files.append((entry.name, st.st_size, st.st_mtime_ns))
+    except FileNotFoundError:
+        return None
+    return (folder_mtime, tuple(sorted(files)))
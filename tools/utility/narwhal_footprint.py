@@ -0,0 +1,182 @@
+"""
+granule footprint index
+
+the outline of every l2 granule (sampled along the edges of the valid pixels) is saved in a
+sqlite file keyed by the granule name, computed once per granule with the geolocation reader.
+Before building any kdtree, granules whose footprint is far from all the validation sites
+(more than search_center_radius) are skipped.
+
+    db_path = os.path.join(input_folder, product1, 'granule_footprint.sqlite')
+    filev = select_granules(filev, lon_loc, lat_loc, search_center_radius, db_path)
+
+Notes:
+longitude is unwrapped along the outline, so granules across the antimeridian are handled,
+granules around the poles are always kept.
+"""
+import os
+import json
+import sqlite3
+
+import numpy as np
+
+from tools.narwhal_granule import read_geolocation
+
+R_EARTH = 6371.0
+
+def lonlat_to_xyz(lon, lat):
+    """convert lon, lat in degree into unit vectors on the sphere (ECEF), shape (..., 3)"""
+    lon = np.radians(np.asarray(lon, dtype=float))
+    lat = np.radians(np.asarray(lat, dtype=float))
+    return np.stack((np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)), axis=-1)
+
+def gc_distance_xyz(xyz1, xyz2):
+    """great circle distance in km between unit vectors, broadcast over the leading dimensions"""
+    chord = np.linalg.norm(xyz1 - xyz2, axis=-1)
+    return 2*R_EARTH*np.arcsin(np.clip(chord/2, 0, 1))
+
+def get_footprint(lon, lat, step=10):
+    """
+    outline of the valid pixels of a granule, every step lines/pixels:
+    first line (left to right), right edge, last line (right to left), left edge
+
+    return lon_ring, lat_ring and the maximum distance (km) between two neighbor vertices
+    """
+    valid = np.isfinite(lon) & np.isfinite(lat)
+    rows = np.nonzero(valid.any(axis=1))[0]
+    if len(rows) == 0:
+        return None, None, None
+
+    rows_s = rows[::step]
+    if rows_s[-1] != rows[-1]:
+        rows_s = np.append(rows_s, rows[-1])
+
+    # first and last valid pixel on each sampled line
+    left = np.argmax(valid[rows_s], axis=1)
+    right = valid.shape[1] - 1 - np.argmax(valid[rows_s][:, ::-1], axis=1)
+
+    def sample_line(row):
+        cols = np.nonzero(valid[row])[0]
+        cols_s = cols[::step]
+        if cols_s[-1] != cols[-1]:
+            cols_s = np.append(cols_s, cols[-1])
+        return cols_s
+
+    cols_first = sample_line(rows_s[0])
+    cols_last = sample_line(rows_s[-1])
+
+    ring_rows = np.concatenate((np.full(len(cols_first), rows_s[0]), rows_s, \
+                                np.full(len(cols_last), rows_s[-1]), rows_s[::-1]))
+    ring_cols = np.concatenate((cols_first, right, cols_last[::-1], left[::-1]))
+
+    lon_ring = lon[ring_rows, ring_cols].astype(float)
+    lat_ring = lat[ring_rows, ring_cols].astype(float)
+
+    xyz = lonlat_to_xyz(lon_ring, lat_ring)
+    spacing = gc_distance_xyz(xyz, np.roll(xyz, -1, axis=0)).max()
+
+    return lon_ring, lat_ring, float(spacing)
+
+def check_footprint(lon_ring, lat_ring, spacing, lon_loc, lat_loc, search_center_radius):
+    """
+    check whether each site is inside the footprint or within search_center_radius (km) of it
+
+    the outline longitude is unwrapped, sites are tested at lon-360, lon, lon+360,
+    so it works across the antimeridian, if the outline goes around a pole, return all True
+
+    return boolean array for all the sites
+    """
+    lon_loc = np.asarray(lon_loc, dtype=float)
+    lat_loc = np.asarray(lat_loc, dtype=float)
+
+    lon_u = np.degrees(np.unwrap(np.radians(lon_ring)))
+    #a ring around a pole does not close after unwrapping
+    if abs(lon_u[-1] - lon_u[0]) > 180:
+        return np.ones(len(lon_loc), dtype=bool)
+
+    # ray casting (crossing number) for all sites and all the edges at once
+    x1, y1 = lon_u[None, :], lat_ring[None, :]
+    x2, y2 = np.roll(lon_u, -1)[None, :], np.roll(lat_ring, -1)[None, :]
+    py = lat_loc[:, None]
+    crossing = (y1 > py) != (y2 > py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x1 + (py - y1)*(x2 - x1)/(y2 - y1)
+
+    inside = np.zeros(len(lon_loc), dtype=bool)
+    for shift in [-360, 0, 360]:
+        px = lon_loc[:, None] + shift
+        inside |= (np.sum(crossing & (px < x_cross), axis=1) % 2) == 1
+
+    # distance to the closest vertex, a site within radius of an edge is at most
+    # radius + spacing/2 from one of its vertices
+    cos_angle = lonlat_to_xyz(lon_loc, lat_loc) @ lonlat_to_xyz(lon_ring, lat_ring).T
+    dis = R_EARTH*np.arccos(np.clip(cos_angle, -1, 1))
+    near = np.nanmin(dis, axis=1) <= (search_center_radius + spacing/2)
+
+    return inside | near
+
+def open_footprint_db(db_path):
+    """open (create) the footprint index"""
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.execute("""CREATE TABLE IF NOT EXISTS footprint (
+                        filename TEXT PRIMARY KEY,
+                        timestamp TEXT,
+                        file_size INTEGER,
+                        lon TEXT,
+                        lat TEXT,
+                        spacing_km REAL)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_footprint_time ON footprint (timestamp)")
+    conn.commit()
+    return conn
+
+def get_granule_footprint(conn, nc_path, step=10):
+    """
+    get the footprint from the index, computed and saved if not available
+    (or if the file size changed)
+
+    return lon_ring, lat_ring, spacing
+    """
+    filename = os.path.basename(nc_path)
+    file_size = os.path.getsize(nc_path)
+
+    row = conn.execute("SELECT file_size, lon, lat, spacing_km FROM footprint WHERE filename=?", \
+                       (filename,)).fetchone()
+    if row is not None and row[0] == file_size:
+        if row[1] is None:
+            return None, None, None
+        return np.array(json.loads(row[1])), np.array(json.loads(row[2])), row[3]
+
+    lon, lat, datetime1 = read_geolocation(nc_path)
+    lon_ring, lat_ring, spacing = get_footprint(lon, lat, step=step)
+
+    lon_str = json.dumps(np.round(lon_ring, 5).tolist()) if lon_ring is not None else None
+    lat_str = json.dumps(np.round(lat_ring, 5).tolist()) if lat_ring is not None else None
+    conn.execute("INSERT OR REPLACE INTO footprint VALUES (?, ?, ?, ?, ?, ?)", \
+                 (filename, datetime1, file_size, lon_str, lat_str, spacing))
+    conn.commit()
+
+    return lon_ring, lat_ring, spacing
+
+def select_granules(filev, lon_loc, lat_loc, search_center_radius, db_path, step=10):
+    """
+    keep only the granules which may contain a site within search_center_radius (km)
+    granules failed to get the footprint are kept, so the error is shown in the search
+    """
+    conn = open_footprint_db(db_path)
+    filev2 = []
+    try:
+        for nc_path in filev:
+            try:
+                lon_ring, lat_ring, spacing = get_granule_footprint(conn, nc_path, step=step)
+                if lon_ring is None:
+                    continue
+                if check_footprint(lon_ring, lat_ring, spacing, lon_loc, lat_loc, search_center_radius).any():
+                    filev2.append(nc_path)
+            except Exception as e:
+                print(f"  Error getting footprint {nc_path}: {str(e)}")
+                filev2.append(nc_path)
+    finally:
+        conn.close()
+
+    print(f"granules overlap with validation sites: {len(filev2)} of {len(filev)}")
+    return filev2
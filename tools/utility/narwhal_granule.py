@@ -0,0 +1,80 @@
+"""
+light readers for PACE L2 granules
+
+only open the group or variables needed with netCDF4, rather than loading and merging
+every group with xr.open_datatree / xr.merge
+
+decoding follows xarray: mask _FillValue/missing_value, apply scale_factor/add_offset,
+valid_min/valid_max are not used for masking
+"""
+import re
+import numpy as np
+from netCDF4 import Dataset
+
+def get_granule_timestamp(nc_path):
+    """get the timestamp YYYYMMDDTHHMMSS from the granule name"""
+    return re.search(r'(\d{8}T\d{6})', nc_path).group(1)
+
+def find_nc_var(group, var_name):
+    """search the variable in the group and all its sub groups, return None if not found"""
+    if var_name in group.variables:
+        return group.variables[var_name]
+    for sub in group.groups.values():
+        var = find_nc_var(sub, var_name)
+        if var is not None:
+            return var
+    return None
+
+def decode_nc_var(var):
+    """
+    read the variable into a numpy array, decode as xarray does:
+    fill values to nan, then scale and offset
+    """
+    var.set_auto_maskandscale(False)
+    data = np.asarray(var[:])
+
+    attrs = var.ncattrs()
+    fillv = [var.getncattr(key) for key in ['_FillValue', 'missing_value'] if key in attrs]
+    scale = var.getncattr('scale_factor') if 'scale_factor' in attrs else None
+    offset = var.getncattr('add_offset') if 'add_offset' in attrs else None
+
+    if fillv or scale is not None or offset is not None:
+        mask = np.zeros(data.shape, dtype=bool)
+        for fill1 in fillv:
+            mask |= (data == np.asarray(fill1).astype(data.dtype))
+        data = data.astype(float)
+        if scale is not None:
+            data = data*scale
+        if offset is not None:
+            data = data+offset
+        data[mask] = np.nan
+
+    return data
+
+def read_granule_vars(nc_path, var_names, group=None):
+    """
+    read a list of variables from the granule, searching all groups (or only group if given)
+    missing variables are skipped, check the keys of the output
+
+    return a dict of {var_name: numpy array}
+    """
+    datav = {}
+    with Dataset(nc_path, 'r') as nc:
+        root = nc.groups[group] if (group and group in nc.groups) else nc
+        for var_name in var_names:
+            var = find_nc_var(root, var_name)
+            if var is None:
+                print(f"          ***Warning: Variable '{var_name}' not found in {nc_path}")
+                continue
+            datav[var_name] = decode_nc_var(var)
+    return datav
+
+def read_geolocation(nc_path, group='geolocation_data', lon_var='longitude', lat_var='latitude'):
+    """
+    read longitude and latitude only, used in the search step
+
+    return lon, lat (2d arrays) and the timestamp of the granule
+    """
+    datetime1 = get_granule_timestamp(nc_path)
+    datav = read_granule_vars(nc_path, [lon_var, lat_var], group=group)
+    return datav[lon_var], datav[lat_var], datetime1
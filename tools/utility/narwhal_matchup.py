@@ -32,16 +32,19 @@ import matplotlib.pyplot as plt
 #if removed, there is issue to open xarray
 from tools.aeronet_matchup_search import check_netcdf_file
 
-from tools.aeronet_matchup_extract import subset_time_pace_aeronet, subset_loc_pace_data, \
-                                            prepare_date, prepare_vars
+from tools.aeronet_matchup_extract import subset_time_pace_aeronet, subset_time_pace_aeronet_grouped, GROUPED_FALLBACK, \
+                                            search_extract_pace_data, \
+                                            prepare_date, prepare_vars, get_pace_vars, get_date_site_index
 from tools.narwhal_matchup_plot import plot_corr_one_density_kde, plot_four_csv_maps
 from tools.narwhal_tools import find_closest_wavelength_vars
 from tools.aeronet_matchup_man import get_man_all
+from tools.narwhal_site_catalog import get_site_catalog
 
 from tools.aeronet_matchup_download import get_aeronet_file, process_local_nc_files
 from tools.narwhal_pace import download_pace_data
-from tools.aeronet_matchup_search import aeronet_search, plot_search
+from tools.aeronet_matchup_search import plot_search
 from tools.aeronet_matchup_format import clean_pace_data
+from tools.aeronet_matchup_match import get_fit_diagnostics, plot_fit_diagnostics
 
 from tools.narwhal_matchup_html_suite import create_html_with_embedded_images
 from tools.narwhal_matchup_order import get_image_files,ordered_image_list
@@ -56,7 +59,8 @@ def narwhal_matchup_daily(matchup_save_folder, matchup_save_folder2, html_save_f
                             all_rules, \
                             save_subset_loc_path, share_dir_base,\
                             val_source='AERONET', flag_rm=True, flag_earthdata_cloud=False, \
-                            df0=None, logo_path=None, max_order=-1):
+                            df0=None, logo_path=None, max_order=-1, footprint_db=None, match_mode='batch', n_workers=1,\
+                            interp_mode=None):
     """
     define the main function to run matchup
 
@@ -89,6 +93,10 @@ def narwhal_matchup_daily(matchup_save_folder, matchup_save_folder2, html_save_f
         flag_rm
         flag_earthdata_cloud
         max_order: used for interpolation (>=0 linear, <0 spline), data outside range, set to nan
+        footprint_db: sqlite index of granule footprints, skip granules far from all sites (None: search all)
+        match_mode: location search, 'batch' (lon/lat kdtree), 'ecef' (great circle radius), 'loop'
+        n_workers: number of processes for the granule search and extraction
+        interp_mode: 'angstrom' log-log interpolation for aod type variables (not sda), None use max_order
 
 
     Path example:
@@ -120,7 +128,7 @@ def narwhal_matchup_daily(matchup_save_folder, matchup_save_folder2, html_save_f
             #loc_suite1 = 'AOD15'
             loc_search_path = os.path.join(val_path1, loc_suite1)
             print("search path for AERONET or AERONET OC locations:", loc_search_path)
-            aeronet_list_df1 = get_man_all(loc_search_path, tspan, flag_man=False, flag_list=True)
+            aeronet_list_df1 = get_val_locations(loc_search_path, tspan, flag_man=False)
         print(f"finish for {val_source} data")
         
     elif(val_source.upper() in ['MAN','PACE_PAX', 'EARTHCARE']):
@@ -128,7 +136,7 @@ def narwhal_matchup_daily(matchup_save_folder, matchup_save_folder2, html_save_f
         #loc_suite1 = 'MAN_AOD15_series'
         loc_search_path = os.path.join(val_path1, loc_suite1)
         print("search path for MAN/PACE_PAX/EARTHCARE locations:", loc_search_path)
-        aeronet_list_df1 = get_man_all(loc_search_path, tspan, flag_list=True)
+        aeronet_list_df1 = get_val_locations(loc_search_path, tspan, flag_man=True)
         print(f"finish for {val_source} data")
     else:
         print(f"{val_source} do not exist")
@@ -178,7 +186,15 @@ def narwhal_matchup_daily(matchup_save_folder, matchup_save_folder2, html_save_f
     filev=glob.glob(os.path.join(l2_path1,'*.nc'))
     print("total files:", len(filev))
     #search_center_radius = 5 #km #center distance
-    indexvv, boundingboxv = aeronet_search(aeronet_list_df1, filev, search_center_radius=search_center_radius)
+    #search_grid_delta=2
+    #search the locations and compute mean and std within a grid range, one pass per granule
+    #only read the pace variables used for val_source in val_var_list.csv
+    pace_vars = get_pace_vars(val_source, rules=filter_rules)
+    indexvv, boundingboxv, pace_df_mean_all, pace_df_std_all, wvv = \
+        search_extract_pace_data(aeronet_list_df1, filev, filter_rules, search_center_radius=search_center_radius, \
+                                 search_grid_delta=search_grid_delta, match_mode=match_mode, \
+                                 footprint_db=footprint_db, save_subset_loc_path=save_subset_loc_path, \
+                                 n_workers=n_workers, pace_vars=pace_vars)
     
     #### plot the matched aeronet location in l2 locations
     #### check matched points
@@ -197,15 +213,7 @@ def narwhal_matchup_daily(matchup_save_folder, matchup_save_folder2, html_save_f
     
     plot_search(indexvv, boundingboxv, outfile)
     
-    ##### create df based on the matched data, and compute mean and std within a grid range
-    #search_grid_delta=2
-    ## turn off temp
-    try:
-        pace_df_mean_all, pace_df_std_all, wvv = subset_loc_pace_data(indexvv, filev, filter_rules, \
-                                                            search_grid_delta=search_grid_delta,\
-                                                            save_subset_loc_path=save_subset_loc_path)
-    #turn off except
-    except:
+    if wvv is None:
         sys.exit("Cannot find pace matchups based on locations")
 
     print("number of all pixel found:", len(pace_df_mean_all))
@@ -258,6 +266,11 @@ def narwhal_matchup_daily(matchup_save_folder, matchup_save_folder2, html_save_f
         # Unpack the row directly
         val_source_row, suite1, old_start1, old_end1, new_start1, wvv_option = row
         input_is_sda = isinstance(suite1, str) and ('SDA' in suite1.upper())
+        #angstrom interpolation only for aod type variables
+        if (new_start1 in ['aot_wv', 'aot_fine_wv', 'aot_coarse_wv']) and (not input_is_sda):
+            interp_mode1 = interp_mode
+        else:
+            interp_mode1 = None
         
         # Handle wavelength dependency
         if wvv_option == 'wvv':
@@ -275,7 +288,7 @@ def narwhal_matchup_daily(matchup_save_folder, matchup_save_folder2, html_save_f
                                 pace_df_mean_all, pace_df_std_all,\
                                 old_start1, old_end1, new_start1, wvv_input, delta_hour, \
                                 input_is_sda=input_is_sda, wv550=wv550, \
-                                val_source=val_source, df0=df0, max_order=max_order)
+                                val_source=val_source, df0=df0, max_order=max_order, interp_mode=interp_mode1)
         except Exception as e:
             print(f"  Error in finding matchups: {str(e)}")
             print("  Full traceback:")
@@ -396,12 +409,29 @@ def narwhal_matchup_daily(matchup_save_folder, matchup_save_folder2, html_save_f
 ###################################################################################
 
 
+def get_val_locations(loc_search_path, tspan, flag_man=True):
+    """
+    site names and locations in tspan from the site catalog (narwhal_site_catalog),
+    if the catalog fails, read all the files (get_man_all)
+    """
+    try:
+        return get_site_catalog(loc_search_path, tspan, flag_man=flag_man)
+    except Exception as e:
+        print(f"  Error in site catalog: {str(e)}, read all the files")
+        traceback.print_exc()
+        return get_man_all(loc_search_path, tspan, flag_man=flag_man, flag_list=True)
+
 def process_all_folders(folder1v, site1v, pace_df_mean_all, pace_df_std_all, wvv_input, all_vars, 
                        extra_vars=None, delta_hour=None, old_start1=None, old_end1=None, 
                        new_start1=None, input_is_sda=False, val_source='AERONET', \
-                        df0=None, max_order=1, tmp_plot_path0=None):
+                        df0=None, max_order=1, tmp_plot_path0=None, flag_grouped=True, interp_mode=None,\
+                        fit_diag=None):
     """
     Process all folders and combine the resulting DataFrames.
+    flag_grouped: match all the sites of a folder together (subset_time_pace_aeronet_grouped),
+        False: site by site (subset_time_pace_aeronet)
+    interp_mode: 'angstrom' log-log interpolation, None use max_order
+    fit_diag: collector of the interpolation check (get_fit_diagnostics)
     
     Parameters:
     -----------
@@ -440,6 +470,10 @@ def process_all_folders(folder1v, site1v, pace_df_mean_all, pace_df_std_all, wvv
     pace_df_std_alls = []
     
     print(f"Processing {len(folder1v)} folders...")
+
+    #sites with pace data on each day, only these sites are searched in the day folder
+    date_site_index = get_date_site_index(pace_df_mean_all, delta_hour=delta_hour)
+    GROUPED_FALLBACK['count'] = 0
     
     for folder1 in tqdm(folder1v):
         #print(f"Processing folder {i+1}/{len(folder1v)}: {folder1}")
@@ -453,32 +487,45 @@ def process_all_folders(folder1v, site1v, pace_df_mean_all, pace_df_std_all, wvv
         #print(f"old_start1={old_start1}, old_end1={old_end1}, new_start1={new_start1}")
         old_start1, old_end1, new_start1 = map(clean_value, [old_start1, old_end1, new_start1])
         #print(f"old_start1={old_start1}, old_end1={old_end1}, new_start1={new_start1}")
+
+        date1 = os.path.basename(os.path.normpath(folder1))
+        site_day = date_site_index.get(date1, set())
+        site1v_day = [site1 for site1 in site1v if site1 in site_day]
+        print(f"  {date1}: {len(site1v_day)} of {len(site1v)} sites with pace data")
+        if len(site1v_day) == 0:
+            continue
         
+        if(flag_grouped):
+            subset_func = subset_time_pace_aeronet_grouped
+        else:
+            subset_func = subset_time_pace_aeronet
+
         try:
-            aeronet_df_mean_all, aeronet_df_std_all, pace_df_mean_all, pace_df_std_all = \
-                subset_time_pace_aeronet(folder1, site1v, \
+            aeronet_df_mean_day, aeronet_df_std_day, pace_df_mean_day, pace_df_std_day = \
+                subset_func(folder1, site1v_day, \
                                          pace_df_mean_all, pace_df_std_all, wvv_input, all_vars, \
                                          extra_vars=extra_vars, delta_hour=delta_hour,\
                                          old_start1=old_start1, old_end1=old_end1, new_start1=new_start1,\
                                          input_is_sda=input_is_sda, val_source=val_source, \
-                                         df0=df0, max_order=max_order, tmp_plot_path0=tmp_plot_path0)
+                                         df0=df0, max_order=max_order, tmp_plot_path0=tmp_plot_path0, \
+                                         interp_mode=interp_mode, fit_diag=fit_diag)
             
             # Append each DataFrame to the respective list (only if not empty/None)
-            if aeronet_df_mean_all is not None and not aeronet_df_mean_all.empty:
-                aeronet_df_mean_alls.append(aeronet_df_mean_all)
-                print(f"  Added AERONET mean data: {aeronet_df_mean_all.shape}")
+            if aeronet_df_mean_day is not None and not aeronet_df_mean_day.empty:
+                aeronet_df_mean_alls.append(aeronet_df_mean_day)
+                print(f"  Added AERONET mean data: {aeronet_df_mean_day.shape}")
             
-            if aeronet_df_std_all is not None and not aeronet_df_std_all.empty:
-                aeronet_df_std_alls.append(aeronet_df_std_all)
-                print(f"  Added AERONET std data: {aeronet_df_std_all.shape}")
+            if aeronet_df_std_day is not None and not aeronet_df_std_day.empty:
+                aeronet_df_std_alls.append(aeronet_df_std_day)
+                print(f"  Added AERONET std data: {aeronet_df_std_day.shape}")
             
-            if pace_df_mean_all is not None and not pace_df_mean_all.empty:
-                pace_df_mean_alls.append(pace_df_mean_all)
-                print(f"  Added PACE mean data: {pace_df_mean_all.shape}")
+            if pace_df_mean_day is not None and not pace_df_mean_day.empty:
+                pace_df_mean_alls.append(pace_df_mean_day)
+                print(f"  Added PACE mean data: {pace_df_mean_day.shape}")
             
-            if pace_df_std_all is not None and not pace_df_std_all.empty:
-                pace_df_std_alls.append(pace_df_std_all)
-                print(f"  Added PACE std data: {pace_df_std_all.shape}")
+            if pace_df_std_day is not None and not pace_df_std_day.empty:
+                pace_df_std_alls.append(pace_df_std_day)
+                print(f"  Added PACE std data: {pace_df_std_day.shape}")
 
         #turn off except 
         except Exception as e:
@@ -507,6 +554,8 @@ def process_all_folders(folder1v, site1v, pace_df_mean_all, pace_df_std_all, wvv
     print(f"  AERONET std: {combined_target_std_df.shape}")
     print(f"  PACE mean: {combined_pace_mean_df.shape}")
     print(f"  PACE std: {combined_pace_std_df.shape}")
+    if(flag_grouped and GROUPED_FALLBACK['count'] > 0):
+        print(f"  ***Warning: site by site fallback used for {GROUPED_FALLBACK['count']} folders")
     
     return combined_target_mean_df, combined_target_std_df, combined_pace_mean_df, combined_pace_std_df
 
@@ -514,7 +563,8 @@ def get_matchup_results(out_dir1, out_dir2, tspan, date_list, \
                         aeronet_path1, site1v, product1, suite1, \
                         pace_df_mean_all, pace_df_std_all,\
                         old_start1, old_end1, new_start1, wvv_input, delta_hour,\
-                        input_is_sda=False, wv550=550, val_source='AERONET', df0=None, max_order=1):
+                        input_is_sda=False, wv550=550, val_source='AERONET', df0=None, max_order=1, \
+                        interp_mode=None):
     """
     get the final matchpu results, and make plots
     wvv_input=None for variable do not have a wv dimension
@@ -539,13 +589,24 @@ def get_matchup_results(out_dir1, out_dir2, tspan, date_list, \
 
     #for tempolary save of plot files
     tmp_plot_path0 = os.path.join(out_dir2, suite1+'_'+new_start1)
+
+    #sample of the interpolated spectra from all the sites and days, plotted once
+    fit_diag = get_fit_diagnostics(nsample=6)
     
     aeronet_df_mean_all, aeronet_df_std_all, pace_df_mean_all, pace_df_std_all = \
         process_all_folders(folder1v, site1v, pace_df_mean_all, pace_df_std_all, wvv_input, all_vars, 
                                extra_vars=extra_vars, delta_hour=delta_hour,\
                               old_start1=old_start1, old_end1=old_end1, new_start1=new_start1,\
                               input_is_sda=input_is_sda, val_source=val_source, df0=df0, max_order=max_order,\
-                              tmp_plot_path0=tmp_plot_path0)
+                              tmp_plot_path0=tmp_plot_path0, interp_mode=interp_mode, fit_diag=fit_diag)
+
+    if wvv_input is not None and not input_is_sda:
+        try:
+            plot_fit_diagnostics(fit_diag, max_order=max_order, new_start1=new_start1, \
+                                 outfile=tmp_plot_path0+'_interpolation_check.png')
+        except Exception as e:
+            print(f"  Error in interpolation check plot: {str(e)}")
+            traceback.print_exc()
     
     
     #save data
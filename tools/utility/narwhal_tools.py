@@ -61,6 +61,15 @@ def print_threads_info():
     log_key_value("OPENBLAS_NUM_THREADS", os.environ.get("OPENBLAS_NUM_THREADS", "Not set"))
     log_key_value("OMP_NUM_THREADS", os.environ.get("OMP_NUM_THREADS", "Not set"))
 
+def get_n_workers(default=1):
+    """
+    number of worker processes for the granule loops, from SLURM_CPUS_PER_TASK
+    use default when not running under slurm
+    """
+    n_workers = os.environ.get('SLURM_CPUS_PER_TASK')
+    if n_workers is None:
+        return default
+    return max(int(n_workers), 1)
 
 #def get_rules_str(rules):
 #    """convert to string as file name